@@ -0,0 +1,1805 @@
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+
+import metrics
+
+# 不依賴 Streamlit 的分析核心；yfinance、scipy、plotly 只在實際用到時才匯入，批次工作與 CLI 啟動較快
+
+OHLCV = ["Open", "High", "Low", "Close", "Volume"]
+PERIODS = ["1mo", "3mo", "6mo", "1y", "2y"]
+PERIOD_OFFSETS = {
+    "1mo": pd.DateOffset(months=1),
+    "3mo": pd.DateOffset(months=3),
+    "6mo": pd.DateOffset(months=6),
+    "1y": pd.DateOffset(years=1),
+    "2y": pd.DateOffset(years=2),
+}
+
+def clean_bars(df):
+    if df.empty:
+        return pd.DataFrame()
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = df.columns.get_level_values(0)
+    df = df[[c for c in OHLCV if c in df.columns]].dropna()
+    return df[~df.index.duplicated(keep="last")].sort_index()
+
+def slice_period(df, period):
+    # period 以最後一根K棒為基準往前切，讓離線資料也有一致的結果
+    if df.empty or period not in PERIOD_OFFSETS:
+        return df
+    return df[df.index >= df.index[-1] - PERIOD_OFFSETS[period]]
+
+class YFinanceSource:
+    def fetch(self, symbol, interval, period=None, start=None):
+        import yfinance as yf
+        if start is not None:
+            df = yf.download(symbol, start=start.strftime("%Y-%m-%d"),
+                             interval=interval, progress=False)
+        else:
+            df = yf.download(symbol, period=period, interval=interval, progress=False)
+        return clean_bars(df)
+
+    def fetch_many(self, symbols, interval, period=None, start=None):
+        import yfinance as yf
+        kwargs = dict(interval=interval, group_by="ticker", progress=False, threads=True)
+        if start is not None:
+            df = yf.download(symbols, start=start.strftime("%Y-%m-%d"), **kwargs)
+        else:
+            df = yf.download(symbols, period=period, **kwargs)
+        out = {}
+        for sym in symbols:
+            if isinstance(df.columns, pd.MultiIndex):
+                part = df[sym].copy() if sym in df.columns.get_level_values(0) else pd.DataFrame()
+            else:
+                part = df.copy() if len(symbols) == 1 else pd.DataFrame()
+            out[sym] = clean_bars(part)
+        return out
+
+class CSVSource:
+    # 離線/測試用：讀取 <root>/<symbol>_<interval>.csv
+    def __init__(self, root):
+        self.root = root
+
+    def fetch(self, symbol, interval, period=None, start=None):
+        path = os.path.join(self.root, symbol + "_" + interval + ".csv")
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        df = clean_bars(pd.read_csv(path, index_col=0, parse_dates=True))
+        if start is not None:
+            return df[df.index >= start]
+        return slice_period(df, period)
+
+    def fetch_many(self, symbols, interval, period=None, start=None):
+        return {sym: self.fetch(sym, interval, period=period, start=start) for sym in symbols}
+
+class BarStore:
+    # 每個 (symbol, interval) 一個 (6, n) 的 .npy 欄式檔案（時間戳秒數 + OHLCV），以 mmap 讀取
+    def __init__(self, root, source):
+        self.root = root
+        self.source = source
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock(self, symbol, interval):
+        # 同一 (symbol, interval) 的讀取→合併→寫回要串行，不同代碼互不阻塞
+        with self._locks_guard:
+            return self._locks.setdefault((symbol, interval), threading.Lock())
+
+    def _path(self, symbol, interval):
+        return os.path.join(self.root, re.sub(r"[^\w.-]", "_", symbol) + "_" + interval)
+
+    def load(self, symbol, interval):
+        path = self._path(symbol, interval)
+        if not os.path.exists(path + ".json") or not os.path.exists(path + ".npy"):
+            return pd.DataFrame(), {}
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        data = np.load(path + ".npy", mmap_mode="r")
+        index = pd.to_datetime(np.asarray(data[0], dtype=np.int64), unit="s", utc=True)
+        index = index.tz_convert(meta["tz"]) if meta["tz"] else index.tz_localize(None)
+        df = pd.DataFrame({c: data[i + 1] for i, c in enumerate(OHLCV)}, index=index)
+        df.index.name = meta.get("index_name")
+        return df, meta
+
+    def save(self, symbol, interval, df, meta):
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(symbol, interval)
+        index = df.index
+        if index.tz is not None:
+            meta["tz"] = str(index.tz)
+            index = index.tz_convert("UTC").tz_localize(None)
+        else:
+            meta["tz"] = None
+        meta["index_name"] = df.index.name
+        data = np.empty((len(OHLCV) + 1, len(df)), dtype=float)
+        data[0] = index.values.astype("datetime64[s]").astype(np.int64)
+        for i, c in enumerate(OHLCV):
+            data[i + 1] = df[c].values
+        # 暫存檔名唯一（同一行程內多個 session 執行緒也不會互相覆蓋），寫完再原子替換
+        fd, tmp_npy = tempfile.mkstemp(dir=self.root, suffix=".npy.tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, data)
+        fd, tmp_json = tempfile.mkstemp(dir=self.root, suffix=".json.tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_npy, path + ".npy")
+        os.replace(tmp_json, path + ".json")
+
+    def _covered(self, stored, meta, period):
+        return (not stored.empty and period in PERIODS and
+                meta.get("period") in PERIODS and
+                PERIODS.index(period) <= PERIODS.index(meta["period"]))
+
+    def _merge(self, symbol, interval, period, stored, meta, fresh):
+        if fresh.empty and stored.empty:
+            return pd.DataFrame()
+        if not fresh.empty:
+            if stored.empty:
+                stored = fresh
+            else:
+                stored = pd.concat([stored[stored.index < fresh.index[0]], fresh[OHLCV]])
+                stored = stored[~stored.index.duplicated(keep="last")].sort_index()
+            self.save(symbol, interval, stored, meta)
+        return slice_period(stored, period)
+
+    def get(self, symbol, period, interval):
+        with self._lock(symbol, interval):
+            return self._get(symbol, period, interval)
+
+    def _get(self, symbol, period, interval):
+        stored, meta = self.load(symbol, interval)
+        if self._covered(stored, meta, period):
+            # 只補抓最後一根（可能尚未收完）之後的K棒
+            fresh = self.source.fetch(symbol, interval, start=stored.index[-1])
+        else:
+            fresh = self.source.fetch(symbol, interval, period=period)
+            if period in PERIODS:
+                meta["period"] = period
+        return self._merge(symbol, interval, period, stored, meta, fresh)
+
+    def get_many(self, symbols, period, interval):
+        # 依代碼排序取鎖，避免與其他批次互相等待
+        with ExitStack() as stack:
+            for sym in sorted(set(symbols)):
+                stack.enter_context(self._lock(sym, interval))
+            return self._get_many(symbols, period, interval)
+
+    def _get_many(self, symbols, period, interval):
+        # 已有資料的代碼以最早的最後K棒時間一次補抓，其餘一次抓完整週期
+        loaded = {sym: self.load(sym, interval) for sym in symbols}
+        covered = [sym for sym in symbols if self._covered(*loaded[sym], period)]
+        missing = [sym for sym in symbols if sym not in covered]
+        fresh = {}
+        if covered:
+            start = min(loaded[sym][0].index[-1] for sym in covered)
+            fresh.update(self.source.fetch_many(covered, interval, start=start))
+            metrics.inc("analyzer_bar_fetch_total", len(covered), mode="delta")
+        if missing:
+            fresh.update(self.source.fetch_many(missing, interval, period=period))
+            metrics.inc("analyzer_bar_fetch_total", len(missing), mode="full")
+            for sym in missing:
+                if period in PERIODS:
+                    loaded[sym][1]["period"] = period
+        metrics.inc("analyzer_bars_fetched_total", sum(len(f) for f in fresh.values()))
+        return {sym: self._merge(sym, interval, period, *loaded[sym],
+                                 fresh.get(sym, pd.DataFrame()))
+                for sym in symbols}
+
+DATA_CACHE_BYTES = int(os.environ.get("DATA_CACHE_MB", "512")) * 2**20
+DATA_CACHE_TTL = 300
+
+class SingleFlight:
+    # 相同 key 的並行呼叫只執行一次，其餘等待並共用同一個結果（或例外）
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            metrics.inc("analyzer_singleflight_total", event="shared")
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        metrics.inc("analyzer_singleflight_total", event="leader")
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+def price_decimals(values, max_decimals=6):
+    if len(values) == 0:
+        return None
+    scale = max(1.0, float(np.abs(values).max()))
+    for d in range(max_decimals + 1):
+        if np.all(np.abs(np.round(values, d) - values) <= 1e-9 * scale):
+            return d
+    return None
+
+PRICE_DISPLAY_DECIMALS = 4
+
+def compact_prices(ohlc):
+    # 價格在 float32 下可無損還原時才降為 float32：還原後四捨五入到原小數位與畫面顯示的
+    # 小數位（取較多者）都須完全相同，否則如 67234.12 會顯示成 67234.1172
+    d = price_decimals(ohlc)
+    if d is None:
+        return ohlc
+    d = max(d, PRICE_DISPLAY_DECIMALS)
+    small = ohlc.astype(np.float32)
+    if np.array_equal(np.round(small.astype(np.float64), d), np.round(ohlc, d)):
+        return small
+    return ohlc
+
+class SharedBarCache:
+    # 行程內所有 session 共用的K棒快取：唯讀的欄式陣列、位元組上限 LRU、TTL 到期後以 single-flight 重抓
+    def __init__(self, max_bytes=DATA_CACHE_BYTES, ttl=DATA_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def _pack(df):
+        ohlc = compact_prices(np.ascontiguousarray(df[OHLCV[:4]].values.T, dtype=np.float64))
+        volume = np.array(df["Volume"].values, dtype=np.float64)
+        # 先設唯讀再切成各欄，切出的列視圖才會繼承唯讀
+        for arr in (ohlc, volume):
+            arr.flags.writeable = False
+        columns = dict(zip(OHLCV[:4], ohlc))
+        columns["Volume"] = volume
+        return {"index": df.index, "columns": columns, "fetched": time.monotonic(),
+                "nbytes": ohlc.nbytes + volume.nbytes + df.index.nbytes}
+
+    @staticmethod
+    def _frame(entry):
+        if entry is None or len(entry["index"]) == 0:
+            return pd.DataFrame()
+        return pd.DataFrame(entry["columns"], index=entry["index"], copy=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and time.monotonic() - entry["fetched"] < self.ttl:
+                self._items.move_to_end(key)
+                return entry
+        return None
+
+    def get(self, key, loader):
+        entry = self._lookup(key)
+        if entry is not None:
+            metrics.inc("analyzer_cache_events_total", cache="data", event="hit")
+            return self._frame(entry)
+        metrics.inc("analyzer_cache_events_total", cache="data", event="miss")
+
+        def load():
+            # 等待 single-flight 期間可能已被其他 session 填入
+            cached = self._lookup(key)
+            if cached is not None:
+                return cached
+            df = loader()
+            entry = self._pack(df) if not df.empty else {"index": df.index[:0], "columns": {},
+                                                           "fetched": time.monotonic(), "nbytes": 0}
+            self._put(key, entry)
+            return entry
+
+        return self._frame(self._flight.do(key, load))
+
+    def _put(self, key, entry):
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)["nbytes"]
+            if entry["nbytes"] > self.max_bytes:
+                return
+            self._items[key] = entry
+            self.bytes += entry["nbytes"]
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._items.popitem(last=False)[1]["nbytes"]
+                metrics.inc("analyzer_cache_events_total", cache="data", event="eviction")
+            metrics.set_gauge("analyzer_cache_bytes", self.bytes, cache="data")
+
+PYRAMID_LEVELS = ["5m", "15m", "1h", "1d"]
+INTERVAL_SECONDS = {"5m": 300, "15m": 900, "1h": 3600, "1d": 86400}
+# yfinance 日內資料可回溯的期間有限（5m 約 60 天、1h 約 730 天），各週期只抓可取得的最細K棒
+BASE_INTERVALS = {"1mo": "5m", "3mo": "1h", "6mo": "1h", "1y": "1h", "2y": "1h"}
+_DAY_NS = 86400 * 10**9
+_ANCHOR_NS = 900 * 10**9
+
+def base_interval(period, interval):
+    base = BASE_INTERVALS.get(period)
+    if base is None or interval not in PYRAMID_LEVELS or \
+            PYRAMID_LEVELS.index(interval) < PYRAMID_LEVELS.index(base):
+        return interval
+    return base
+
+def _wall_ns(index):
+    wall = index.tz_localize(None) if index.tz is not None else index
+    return wall.values.astype("datetime64[ns]").astype(np.int64)
+
+def session_anchor(index):
+    # 日內桶的錨點：各日第一根K棒的當地時刻（取整到 15 分）中最早者。
+    # 美股 09:30 開盤的小時K即為 09:30、10:30…，與 yfinance 一致；加密貨幣為 00:00
+    wall = _wall_ns(index)
+    if len(wall) == 0:
+        return 0
+    day = wall // _DAY_NS
+    first = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+    return int((wall[first] % _DAY_NS // _ANCHOR_NS * _ANCHOR_NS).min())
+
+def bucket_starts(index, interval, anchor=None):
+    # 以交易所當地時間切桶，回傳每桶第一根K棒的位置與桶的起始時間
+    wall = _wall_ns(index)
+    day = wall // _DAY_NS
+    if interval == "1d":
+        key = day * _DAY_NS
+    else:
+        step = INTERVAL_SECONDS[interval] * 10**9
+        origin = day * _DAY_NS + (session_anchor(index) if anchor is None else anchor)
+        key = origin + (wall - origin) // step * step
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    if interval == "1d":
+        labels = index[starts].normalize()
+    else:
+        labels = index[starts] - pd.to_timedelta(wall[starts] - key[starts])
+    labels.name = index.name
+    return starts, labels
+
+def _resample(df, interval, anchor=None):
+    starts, labels = bucket_starts(df.index, interval, anchor)
+    ends = np.r_[starts[1:], len(df)] - 1
+    out = pd.DataFrame({
+        "Open": df["Open"].values[starts],
+        "High": np.maximum.reduceat(df["High"].values, starts),
+        "Low": np.minimum.reduceat(df["Low"].values, starts),
+        "Close": df["Close"].values[ends],
+        "Volume": np.add.reduceat(df["Volume"].values, starts),
+    }, index=labels)
+    return out, np.diff(np.r_[starts, len(df)])
+
+def _trim_head(frame, counts):
+    # 週期起點切在桶中間時第一個桶不完整（K棒數比下一個桶少），捨棄
+    if len(counts) > 1 and counts[0] < counts[1]:
+        return frame.iloc[1:], counts[1:]
+    return frame, counts
+
+def resample_ohlcv(df, interval, trim_head=False, anchor=None):
+    if df.empty:
+        return df
+    out, counts = _resample(df, interval, anchor)
+    return _trim_head(out, counts)[0] if trim_head else out
+
+def incremental_pyramid(cache, key, df, base):
+    # 由最細K棒聚合出較粗的各層。週期視窗隨新K棒往後滑動時，只重算開頭被切到的桶
+    # 與上次最後一根（可能尚未收完）所在之後的桶，中間已收完的桶直接沿用
+    levels = PYRAMID_LEVELS[PYRAMID_LEVELS.index(base) + 1:] if base in PYRAMID_LEVELS else []
+    out = {base: df}
+    if df.empty or not levels:
+        return out
+    prev = cache.get(("pyramid",) + key)
+    delta = (prev is not None and prev["first"] <= df.index[0] <= prev["last"]
+             and prev["last"] in df.index)
+    anchor = prev["anchor"] if delta else session_anchor(df.index)
+    metrics.inc("analyzer_pyramid_builds_total", mode="delta" if delta else "full")
+    state = {"levels": {}, "anchor": anchor, "first": df.index[0], "last": df.index[-1]}
+    for lv in levels:
+        old, old_counts = prev["levels"][lv] if delta else (None, None)
+        p = old.index.searchsorted(df.index[0], side="right") if delta else 0
+        if delta and p < len(old):
+            cut = old.index[-1]
+            head, head_counts = _resample(df[df.index < old.index[p]], lv, anchor) \
+                if df.index[0] < old.index[p] else (old.iloc[:0], old_counts[:0])
+            tail, tail_counts = _resample(df[df.index >= cut], lv, anchor)
+            frame = pd.concat([head, old.iloc[p:-1], tail])
+            counts = np.concatenate([head_counts, old_counts[p:-1], tail_counts])
+        else:
+            frame, counts = _resample(df, lv, anchor)
+        frame, counts = _trim_head(frame, counts)
+        state["levels"][lv] = (frame, counts)
+        out[lv] = frame
+    cache.put(("pyramid",) + key, state)
+    return out
+
+PIVOT_ORDERS = range(3, 13)
+BUTTERFLY_BANDS = ((0.70, 0.90), (0.30, 0.95), (1.40, 2.80))
+
+def find_pivots(series, order=5):
+    from scipy.signal import argrelextrema
+    highs = argrelextrema(series.values, np.greater, order=order)[0]
+    lows = argrelextrema(series.values, np.less, order=order)[0]
+    return highs, lows
+
+def multi_order_pivots(values, orders):
+    # argrelextrema(order=k) 的極值必為 order=k-1 的極值，逐級只需再比對 ±k 兩個鄰點
+    from scipy.signal import argrelextrema
+    values = np.asarray(values, dtype=float)
+    orders = sorted(set(int(o) for o in orders))
+    n = len(values)
+    out = {}
+    if not orders:
+        return out
+    highs = argrelextrema(values, np.greater, order=orders[0])[0]
+    lows = argrelextrema(values, np.less, order=orders[0])[0]
+    k = orders[0]
+    for order in orders:
+        while k < order:
+            k += 1
+            highs = highs[(values[highs] > values[np.minimum(highs + k, n - 1)]) &
+                          (values[highs] > values[np.maximum(highs - k, 0)])]
+            lows = lows[(values[lows] < values[np.minimum(lows + k, n - 1)]) &
+                        (values[lows] < values[np.maximum(lows - k, 0)])]
+        out[order] = (highs, lows)
+    return out
+
+def pivot_arrays(values, highs, lows):
+    # 樞紐以平行陣列儲存：索引、種類（1=高點, -1=低點）、價格
+    idx = np.concatenate([lows, highs])
+    kind = np.concatenate([np.full(len(lows), -1, dtype=np.int8),
+                           np.ones(len(highs), dtype=np.int8)])
+    sort = np.argsort(idx, kind="stable")
+    idx, kind = idx[sort], kind[sort]
+    return idx, kind, np.asarray(values, dtype=float)[idx]
+
+PIVOT_ENGINES = {
+    "close": "收盤價極值（argrelextrema）",
+    "zigzag_pct": "高低點 ZigZag（漲跌幅 %）",
+    "zigzag_atr": "高低點 ZigZag（ATR 倍數）",
+}
+ZIGZAG_THRESHOLDS = {"zigzag_pct": 0.05, "zigzag_atr": 2.0}
+ATR_PERIOD = 14
+
+def average_true_range(high, low, close, period=ATR_PERIOD):
+    prev = np.r_[close[0], close[:-1]]
+    tr = np.maximum(high - low, np.maximum(np.abs(high - prev), np.abs(low - prev)))
+    return pd.Series(tr).ewm(alpha=1 / period, adjust=False).mean().values
+
+def zigzag_pivots(high, low, order=5, threshold=0.05, atr=None):
+    # 高點取 High、低點取 Low，候選為 ±order 視窗內的最高/最低（含平頂、平底的第一根）。
+    # 視窗極值用 scipy 的 maximum/minimum_filter1d（單調佇列實作），O(n) 與 order 無關。
+    # 再單趟走過候選：同類取更極端者，反向須離上一個樞紐至少 threshold（比例，或傳入 atr 時為 ATR 倍數），
+    # 高低點嚴格交替。
+    from scipy.ndimage import maximum_filter1d, minimum_filter1d
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    size = 2 * order + 1
+    cand_h = np.flatnonzero(high >= maximum_filter1d(high, size, mode="nearest"))
+    cand_l = np.flatnonzero(low <= minimum_filter1d(low, size, mode="nearest"))
+    cand = np.concatenate([cand_h, cand_l])
+    kinds = np.concatenate([np.ones(len(cand_h), dtype=np.int8), np.full(len(cand_l), -1, dtype=np.int8)])
+    sort = np.argsort(cand, kind="stable")
+    piv_i, piv_k, piv_p = [], [], []
+    for i, k in zip(cand[sort].tolist(), kinds[sort].tolist()):
+        price = high[i] if k == 1 else low[i]
+        if not piv_i:
+            piv_i.append(i), piv_k.append(k), piv_p.append(price)
+        elif k == piv_k[-1]:
+            if (price - piv_p[-1]) * k > 0:
+                piv_i[-1], piv_p[-1] = i, price
+        elif i != piv_i[-1]:
+            need = threshold * (atr[i] if atr is not None else piv_p[-1])
+            if abs(price - piv_p[-1]) >= need:
+                piv_i.append(i), piv_k.append(k), piv_p.append(price)
+    return (np.array(piv_i, dtype=np.int64), np.array(piv_k, dtype=np.int8),
+            np.array(piv_p, dtype=float))
+
+def zigzag_fixed_bars(idx, order, n):
+    # ZigZag 樞紐在下一個反向樞紐成立（其 ±order 視窗收完）之前，仍可能被更極端的K棒取代；
+    # 回傳各樞紐確定不再變動的K棒，最後一個樞紐尚未確定，記為 n
+    return np.minimum(np.r_[np.asarray(idx[1:], dtype=np.int64) + order, n], n)
+
+def pattern_signal_bars(patterns, idx, order, n):
+    # ZigZag 形態要等最後一點確定後才能當作訊號（供 backtest_patterns 的 signal）
+    return zigzag_fixed_bars(idx, order, n)[np.searchsorted(idx, patterns.last_point)]
+
+def pivot_scan(df, orders=PIVOT_ORDERS, engine="close", threshold=None):
+    # 所有偵測器共用的樞紐介面：{order: (索引, 種類, 價格)}
+    if engine == "close":
+        values = df["Close"].values.astype(float)
+        return {order: pivot_arrays(values, highs, lows)
+                for order, (highs, lows) in multi_order_pivots(values, orders).items()}
+    high, low = df["High"].values.astype(float), df["Low"].values.astype(float)
+    if threshold is None:
+        threshold = ZIGZAG_THRESHOLDS[engine]
+    atr = average_true_range(high, low, df["Close"].values.astype(float)) if engine == "zigzag_atr" else None
+    return {order: zigzag_pivots(high, low, order, threshold, atr) for order in orders}
+
+HARMONIC_TOLERANCE = 0.05
+# 諧波形態定義表。ratios：比例名稱 -> (下限, 上限, 理想值)；beyond_x：D 須超越 X；
+# stop：多/空止損乘數；targets：兩個目標 = D 往反轉方向加上（某一段波長 × 係數）。
+# 4 點形態（AB=CD）沒有 X。新增形態只要加一列，不會多掃一次樞紐序列。
+HARMONIC_PATTERNS = [
+    {"name": "butterfly", "label": "蝴蝶", "icon": "🦋", "points": 5,
+     "ratios": {"AB/XA": (0.70, 0.90, 0.786), "BC/AB": (0.30, 0.95, 0.618),
+                "CD/BC": (1.40, 2.80, 1.618)},
+     "beyond_x": True, "stop": (0.97, 1.03), "targets": (("BC", 0.618), ("XA", 0.786))},
+    {"name": "gartley", "label": "加特利", "icon": "🔷", "points": 5,
+     "ratios": {"AB/XA": (0.55, 0.68, 0.618), "BC/AB": (0.382, 0.886, 0.618),
+                "CD/BC": (1.13, 1.618, 1.272), "AD/XA": (0.75, 0.82, 0.786)},
+     "beyond_x": False, "stop": (0.97, 1.03), "targets": (("AD", 0.382), ("AD", 0.618))},
+    {"name": "bat", "label": "蝙蝠", "icon": "🦇", "points": 5,
+     "ratios": {"AB/XA": (0.382, 0.55, 0.5), "BC/AB": (0.382, 0.886, 0.618),
+                "CD/BC": (1.618, 2.618, 2.0), "AD/XA": (0.85, 0.92, 0.886)},
+     "beyond_x": False, "stop": (0.97, 1.03), "targets": (("AD", 0.382), ("AD", 0.618))},
+    {"name": "crab", "label": "螃蟹", "icon": "🦀", "points": 5,
+     "ratios": {"AB/XA": (0.382, 0.618, 0.5), "BC/AB": (0.382, 0.886, 0.618),
+                "CD/BC": (2.24, 3.618, 3.14), "AD/XA": (1.55, 1.70, 1.618)},
+     "beyond_x": True, "stop": (0.97, 1.03), "targets": (("AD", 0.382), ("AD", 0.618))},
+    {"name": "shark", "label": "鯊魚", "icon": "🦈", "points": 5,
+     "ratios": {"BC/AB": (1.13, 1.618, 1.27), "CD/BC": (1.618, 2.24, 1.618),
+                "AD/XA": (0.886, 1.13, 1.0)},
+     "beyond_x": False, "stop": (0.97, 1.03), "targets": (("CD", 0.5), ("CD", 0.618))},
+    {"name": "abcd", "label": "AB=CD", "icon": "📏", "points": 4,
+     "ratios": {"BC/AB": (0.382, 0.886, 0.618), "CD/BC": (1.13, 2.618, 1.618),
+                "CD/AB": (0.90, 1.10, 1.0)},
+     "beyond_x": False, "stop": (0.97, 1.03), "targets": (("AD", 0.382), ("AD", 0.618))},
+]
+
+def butterfly_definition(bands=BUTTERFLY_BANDS):
+    bf = dict(HARMONIC_PATTERNS[0])
+    ratios = {}
+    for (name, (_, _, ideal)), (lo, hi) in zip(bf["ratios"].items(), bands):
+        ratios[name] = (lo, hi, ideal if lo <= ideal <= hi else (lo + hi) / 2)
+    bf["ratios"] = ratios
+    return bf
+
+PATTERN_KINDS = [p["name"] for p in HARMONIC_PATTERNS] + ["wm"]
+PATTERN_POINTS = np.array([p["points"] for p in HARMONIC_PATTERNS] + [2], dtype=np.int64)
+RATIO_NAMES = ["AB/XA", "BC/AB", "CD/BC", "AD/XA", "CD/AB"]
+LEG_NAMES = ["XA", "AB", "BC", "CD", "AD"]
+DIVERGENCE = ["none", "equal", "converge", "diverge"]
+_WM = PATTERN_KINDS.index("wm")
+
+def _type_labels():
+    # [kind, divergence, 是否看漲] -> 顯示名稱，to_records()/labels() 時才查表
+    table = np.empty((len(PATTERN_KINDS), len(DIVERGENCE), 2), dtype=object)
+    for k, pat in enumerate(HARMONIC_PATTERNS):
+        table[k, :, 1] = "看漲" + pat["label"] + " " + pat["icon"] + "↑"
+        table[k, :, 0] = "看跌" + pat["label"] + " " + pat["icon"] + "↓"
+    for d, (w_sub, m_sub) in enumerate([("", ""), ("標準W底", "標準M頭"), ("收斂W底 ✅", "收斂M頭 ✅"),
+                                        ("發散W底 ⚠️", "發散M頭 ⚠️")]):
+        table[_WM, d, 1] = "W底 " + w_sub
+        table[_WM, d, 0] = "M頭 " + m_sub
+    return table
+
+_TYPE_LABELS = _type_labels()
+
+class PatternTable:
+    # 形態結果的欄式儲存：每欄一個連續的 NumPy 陣列，一列一個形態。
+    # kind 為 PATTERN_KINDS 的代碼、direction 1=看漲 -1=看跌；points/prices 為 (n, 5) 靠左排列，
+    # 未用位置填 -1 / NaN；ratios 依 RATIO_NAMES 排列，該形態沒定義的比例為 NaN。
+    COLUMNS = ["kind", "direction", "points", "prices", "ratios", "entry", "stop_loss",
+               "target1", "target2", "neck", "score", "divergence", "vol_ratio"]
+
+    def __init__(self, kind, direction, points, prices, entry, stop_loss, target1, target2=None,
+                 ratios=None, neck=None, score=None, divergence=None, vol_ratio=None):
+        n = len(kind)
+        self.kind = np.asarray(kind, dtype=np.int8)
+        self.direction = np.asarray(direction, dtype=np.int8)
+        self.points = np.asarray(points, dtype=np.int64).reshape(n, 5)
+        self.prices = np.asarray(prices, dtype=float).reshape(n, 5)
+        self.entry = np.asarray(entry, dtype=float)
+        self.stop_loss = np.asarray(stop_loss, dtype=float)
+        self.target1 = np.asarray(target1, dtype=float)
+        self.target2 = np.full(n, np.nan) if target2 is None else np.asarray(target2, dtype=float)
+        self.ratios = (np.full((n, len(RATIO_NAMES)), np.nan) if ratios is None
+                       else np.asarray(ratios, dtype=float).reshape(n, len(RATIO_NAMES)))
+        self.neck = np.full(n, np.nan) if neck is None else np.asarray(neck, dtype=float)
+        self.score = np.full(n, np.nan) if score is None else np.asarray(score, dtype=float)
+        self.divergence = (np.zeros(n, dtype=np.int8) if divergence is None
+                           else np.asarray(divergence, dtype=np.int8))
+        self.vol_ratio = np.full(n, np.nan) if vol_ratio is None else np.asarray(vol_ratio, dtype=float)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0), np.empty((0, 5)), np.empty((0, 5)),
+                   np.empty(0), np.empty(0), np.empty(0))
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls.empty()
+        return cls(**{c: np.concatenate([getattr(t, c) for t in tables]) for c in cls.COLUMNS})
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __getitem__(self, rows):
+        # rows：布林遮罩、索引陣列或 slice
+        return PatternTable(**{c: getattr(self, c)[rows] for c in self.COLUMNS})
+
+    @property
+    def npoints(self):
+        return PATTERN_POINTS[self.kind]
+
+    @property
+    def last_point(self):
+        return self.points[np.arange(len(self)), self.npoints - 1]
+
+    @property
+    def last_price(self):
+        return self.prices[np.arange(len(self)), self.npoints - 1]
+
+    @property
+    def key_level(self):
+        # 形態的關鍵價位：W底/M頭為頸線，諧波形態為最後一點（D）
+        return np.where(self.kind == _WM, self.neck, self.last_price)
+
+    def kind_names(self):
+        return np.array(PATTERN_KINDS)[self.kind]
+
+    def mask(self, kind=None, direction=None):
+        m = np.ones(len(self), dtype=bool)
+        if kind is not None:
+            m &= np.isin(self.kind, [PATTERN_KINDS.index(k) for k in np.atleast_1d(kind)])
+        if direction is not None:
+            m &= self.direction == (1 if direction == "bull" else -1)
+        return m
+
+    def counts(self):
+        # 各形態的看漲/看跌數
+        c = np.bincount(self.kind.astype(np.int64) * 2 + (self.direction > 0),
+                        minlength=2 * len(PATTERN_KINDS)).reshape(-1, 2)
+        return pd.DataFrame({"bull": c[:, 1], "bear": c[:, 0]}, index=PATTERN_KINDS)
+
+    def labels(self):
+        return _TYPE_LABELS[self.kind, self.divergence, (self.direction > 0).astype(np.int8)]
+
+    def to_records(self):
+        # 相容舊介面的 dict 清單（含顯示字串）
+        types = self.labels()
+        out = []
+        for r in range(len(self)):
+            k, bull = int(self.kind[r]), bool(self.direction[r] > 0)
+            n = int(PATTERN_POINTS[k])
+            rec = {"type": types[r], "direction": "bull" if bull else "bear"}
+            if k == _WM:
+                vr = float(self.vol_ratio[r])
+                rec.update({
+                    "divergence": DIVERGENCE[self.divergence[r]],
+                    "points": self.points[r, :n].tolist(), "prices": self.prices[r, :n].tolist(),
+                    "neck": float(self.neck[r]), "entry": float(self.entry[r]),
+                    "stop_loss": float(self.stop_loss[r]), "target": float(self.target1[r]),
+                    "vol_confirm": "✅量縮確認" if vr < 1 else ("⚠️量未縮" if bull else "⚠️量放大"),
+                    "vol_ratio": round(vr, 2) if np.isfinite(vr) else 0,
+                })
+            else:
+                pat = HARMONIC_PATTERNS[k]
+                rec.update({
+                    "points": self.points[r, :n].tolist(), "prices": self.prices[r, :n].tolist(),
+                    "labels": ["X", "A", "B", "C", "D"][5 - n:],
+                    "entry": float(self.entry[r]), "stop_loss": float(self.stop_loss[r]),
+                    "target1": float(self.target1[r]), "target2": float(self.target2[r]),
+                    "ratios": {name: float(self.ratios[r, RATIO_NAMES.index(name)]) for name in pat["ratios"]},
+                    "pattern": pat["name"], "score": round(float(self.score[r]), 3),
+                })
+            out.append(rec)
+        return out
+
+    @classmethod
+    def from_records(cls, records):
+        n = len(records)
+        if not n:
+            return cls.empty()
+        points = np.full((n, 5), -1, dtype=np.int64)
+        prices = np.full((n, 5), np.nan)
+        ratios = np.full((n, len(RATIO_NAMES)), np.nan)
+        cols = {c: np.full(n, np.nan) for c in ("entry", "stop_loss", "target1", "target2", "neck",
+                                               "score", "vol_ratio")}
+        kind = np.empty(n, dtype=np.int8)
+        divergence = np.zeros(n, dtype=np.int8)
+        for r, p in enumerate(records):
+            wm = "neck" in p
+            kind[r] = _WM if wm else PATTERN_KINDS.index(p.get("pattern", "butterfly"))
+            points[r, :len(p["points"])] = p["points"]
+            prices[r, :len(p["prices"])] = p["prices"]
+            for c in ("entry", "stop_loss", "target2", "neck", "score", "vol_ratio"):
+                if p.get(c) is not None:
+                    cols[c][r] = p[c]
+            cols["target1"][r] = p.get("target1", p.get("target"))
+            for name, v in (p.get("ratios") or {}).items():
+                ratios[r, RATIO_NAMES.index(name)] = v
+            if wm:
+                divergence[r] = DIVERGENCE.index(p.get("divergence", "equal"))
+                # 舊格式的量比已四捨五入到 0.01（前量為 0 時記為 0），以 vol_confirm 還原是否量縮
+                shrink = p.get("vol_confirm", "").startswith("✅")
+                if shrink and not cols["vol_ratio"][r] < 1:
+                    cols["vol_ratio"][r] = np.nextafter(1.0, 0.0)
+                elif not shrink and cols["vol_ratio"][r] < 1:
+                    cols["vol_ratio"][r] = np.nan
+        direction = np.array([1 if p["direction"] == "bull" else -1 for p in records], dtype=np.int8)
+        return cls(kind, direction, points, prices, ratios=ratios, divergence=divergence, **cols)
+
+    def to_arrow(self):
+        # 數值欄直接包成 Arrow 陣列（不複製）；points/prices/ratios 為定長 list
+        import pyarrow as pa
+        fixed = lambda a: pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(a).reshape(-1)),
+                                                            a.shape[1])
+        return pa.table({
+            "kind": pa.DictionaryArray.from_arrays(pa.array(self.kind), pa.array(PATTERN_KINDS)),
+            "direction": pa.array(self.direction),
+            "points": fixed(self.points), "prices": fixed(self.prices), "ratios": fixed(self.ratios),
+            "entry": pa.array(self.entry), "stop_loss": pa.array(self.stop_loss),
+            "target1": pa.array(self.target1), "target2": pa.array(self.target2),
+            "neck": pa.array(self.neck), "score": pa.array(self.score),
+            "divergence": pa.DictionaryArray.from_arrays(pa.array(self.divergence), pa.array(DIVERGENCE)),
+            "vol_ratio": pa.array(self.vol_ratio),
+        }, metadata={"ratio_names": ",".join(RATIO_NAMES)})
+
+    def to_parquet(self, path):
+        import pyarrow.parquet as pq
+        pq.write_table(self.to_arrow(), path)
+
+    def to_frame(self):
+        # 攤平成一般欄位（point_0…、price_0…、各比例），給 CSV 或 pandas 使用
+        cols = {"kind": pd.Categorical.from_codes(self.kind, PATTERN_KINDS),
+                "direction": pd.Categorical.from_codes((self.direction > 0).astype(np.int8), ["bear", "bull"])}
+        cols.update({"point_" + str(j): self.points[:, j] for j in range(5)})
+        cols.update({"price_" + str(j): self.prices[:, j] for j in range(5)})
+        cols.update({name: self.ratios[:, j] for j, name in enumerate(RATIO_NAMES)})
+        for c in ("entry", "stop_loss", "target1", "target2", "neck", "score", "vol_ratio"):
+            cols[c] = getattr(self, c)
+        cols["divergence"] = pd.Categorical.from_codes(self.divergence, DIVERGENCE)
+        return pd.DataFrame(cols)
+
+    def to_csv(self, path):
+        self.to_frame().to_csv(path, index=False)
+
+def harmonic_table(idx, kind, price, patterns=HARMONIC_PATTERNS, tolerance=0.0):
+    # 一次滑過 5 個樞紐的視窗算出所有波段與比例，再以定義表逐一套遮罩。
+    # 前面補一個空樞紐，讓 4 點形態也涵蓋最前面的 4 個樞紐。
+    if len(idx) < 4 or not patterns:
+        return PatternTable.empty()
+    idx = np.r_[-1, idx]
+    kind = np.r_[0, kind].astype(np.int8)
+    price = np.r_[np.nan, np.asarray(price, dtype=float)]
+    win_i = np.lib.stride_tricks.sliding_window_view(idx, 5)
+    win_k = np.lib.stride_tricks.sliding_window_view(kind, 5)
+    win_p = np.lib.stride_tricks.sliding_window_view(price, 5)
+    bull4 = (win_k[:, 1:] == np.array([1, -1, 1, -1])).all(axis=1)
+    bear4 = (win_k[:, 1:] == np.array([-1, 1, -1, 1])).all(axis=1)
+    bull5 = bull4 & (win_k[:, 0] == -1)
+    bear5 = bear4 & (win_k[:, 0] == 1)
+    sign = np.where(bull4, 1.0, -1.0)
+    X, A, B, C, D = win_p.T
+    legs = {"XA": (A - X) * sign, "AB": (A - B) * sign, "BC": (C - B) * sign,
+            "CD": (C - D) * sign, "AD": (A - D) * sign}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = {"AB/XA": legs["AB"] / legs["XA"], "BC/AB": legs["BC"] / legs["AB"],
+                 "CD/BC": legs["CD"] / legs["BC"], "AD/XA": legs["AD"] / legs["XA"],
+                 "CD/AB": legs["CD"] / legs["AB"]}
+    beyond_x = (X - D) * sign > 0
+    positive4 = (legs["AB"] > 0) & (legs["BC"] > 0) & (legs["CD"] > 0)
+    positive5 = positive4 & (legs["XA"] > 0)
+
+    hits, scores = [], []
+    for pat in patterns:
+        five = pat["points"] == 5
+        hit = ((bull5 | bear5) & positive5) if five else ((bull4 | bear4) & positive4)
+        if pat["beyond_x"]:
+            hit = hit & beyond_x
+        err = np.zeros(len(sign))
+        for name, (lo, hi, ideal) in pat["ratios"].items():
+            r = ratio[name]
+            hit = hit & (lo * (1 - tolerance) <= r) & (r <= hi * (1 + tolerance))
+            # 誤差以理想值到區間邊界的距離正規化：1 = 剛好在邊界
+            side = np.where(r > ideal, hi - ideal, ideal - lo)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                err = err + np.minimum(np.abs(r - ideal) / np.where(side > 0, side, hi - lo), 2)
+        hits.append(hit)
+        scores.append(1 - err / (2 * len(pat["ratios"])))
+
+    # 依視窗先後、同視窗依定義表順序排列
+    w, p = np.nonzero(np.array(hits).T)
+    codes = np.array([PATTERN_KINDS.index(pat["name"]) for pat in patterns], dtype=np.int8)
+    bull = bull4[w]
+    s = np.where(bull, 1.0, -1.0)
+    # 4 點形態往左移一格，讓 points/prices 一律靠左
+    col = np.arange(5) + (5 - PATTERN_POINTS[codes[p]])[:, None]
+    inside = col < 5
+    col = np.minimum(col, 4)
+    points = np.where(inside, np.take_along_axis(win_i[w], col, axis=1), -1)
+    prices = np.where(inside, np.take_along_axis(win_p[w], col, axis=1), np.nan)
+    d = D[w]
+    stop = np.array([pat["stop"] for pat in patterns], dtype=float)[p, np.where(bull, 0, 1)]
+    leg_values = np.stack([legs[name] for name in LEG_NAMES], axis=1)[w]
+    targets = []
+    for t in range(2):
+        leg = np.array([LEG_NAMES.index(pat["targets"][t][0]) for pat in patterns])[p]
+        coef = np.array([pat["targets"][t][1] for pat in patterns], dtype=float)[p]
+        targets.append(d + s * leg_values[np.arange(len(w)), leg] * coef)
+    used = np.array([[name in pat["ratios"] for name in RATIO_NAMES] for pat in patterns])[p]
+    ratios = np.where(used, np.stack([ratio[name] for name in RATIO_NAMES], axis=1)[w], np.nan)
+    return PatternTable(codes[p], np.where(bull, 1, -1), points, prices, d, d * stop,
+                        targets[0], targets[1], ratios=ratios,
+                        score=np.array(scores).reshape(len(patterns), -1)[p, w])
+
+def harmonic_windows(idx, kind, price, patterns=HARMONIC_PATTERNS, tolerance=0.0):
+    return harmonic_table(idx, kind, price, patterns=patterns, tolerance=tolerance).to_records()
+
+def butterfly_windows(idx, kind, price, bands=BUTTERFLY_BANDS, as_table=False):
+    table = harmonic_table(idx, kind, price, patterns=[butterfly_definition(bands)])
+    return table if as_table else table.to_records()
+
+def butterfly_scan(close, orders=PIVOT_ORDERS, bands=BUTTERFLY_BANDS, as_table=False):
+    values = np.asarray(close, dtype=float)
+    return {order: butterfly_windows(*pivot_arrays(values, highs, lows), bands=bands, as_table=as_table)
+            for order, (highs, lows) in multi_order_pivots(values, orders).items()}
+
+def detect_butterfly(df, order=5, engine="close", threshold=None, as_table=False):
+    if engine == "close":
+        return butterfly_scan(df["Close"].values, orders=[order], as_table=as_table)[order]
+    return butterfly_windows(*pivot_scan(df, [order], engine, threshold)[order], as_table=as_table)
+
+def harmonic_scan(close, orders=PIVOT_ORDERS, patterns=HARMONIC_PATTERNS, tolerance=HARMONIC_TOLERANCE,
+                  as_table=False):
+    values = np.asarray(close, dtype=float)
+    out = {order: harmonic_table(*pivot_arrays(values, highs, lows), patterns=patterns, tolerance=tolerance)
+           for order, (highs, lows) in multi_order_pivots(values, orders).items()}
+    return out if as_table else {order: t.to_records() for order, t in out.items()}
+
+def detect_harmonics(df, order=5, patterns=HARMONIC_PATTERNS, tolerance=HARMONIC_TOLERANCE,
+                     engine="close", threshold=None, as_table=False):
+    table = harmonic_table(*pivot_scan(df, [order], engine, threshold)[order],
+                           patterns=patterns, tolerance=tolerance)
+    return table if as_table else table.to_records()
+
+class RangeExtrema:
+    # Sparse table：建表 O(n log n)，任意區間 [lo, hi] 的最大/最小值查詢 O(1)
+    def __init__(self, values):
+        v = np.asarray(values, dtype=float)
+        self.n = len(v)
+        self._max = [v]
+        self._min = [v]
+        k = 1
+        while 2 * k <= self.n:
+            self._max.append(np.maximum(self._max[-1][:-k], self._max[-1][k:]))
+            self._min.append(np.minimum(self._min[-1][:-k], self._min[-1][k:]))
+            k *= 2
+
+    def _query(self, table, lo, hi, reduce):
+        lo = np.asarray(lo, dtype=np.int64)
+        hi = np.asarray(hi, dtype=np.int64)
+        level = np.zeros(lo.shape, dtype=np.int64)
+        length = hi - lo + 1
+        while True:
+            step = (length >> (level + 1)) > 0
+            if not step.any():
+                break
+            level += step
+        out = np.empty(lo.shape, dtype=float)
+        for j in np.unique(level):
+            m = level == j
+            out[m] = reduce(table[j][lo[m]], table[j][hi[m] - (1 << int(j)) + 1])
+        return out
+
+    def max(self, lo, hi):
+        return self._query(self._max, lo, hi, np.maximum)
+
+    def min(self, lo, hi):
+        return self._query(self._min, lo, hi, np.minimum)
+
+def pivot_pairs(idx, max_span=None):
+    # 相鄰樞紐一律配對；max_span 另外納入間距不超過 max_span 根K棒的非相鄰樞紐
+    n = len(idx)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    first = np.arange(n - 1)
+    if not max_span:
+        return first, first + 1
+    stop = np.maximum(np.searchsorted(idx, idx[:-1] + max_span, side="right"), first + 2)
+    count = stop - first - 1
+    i = np.repeat(first, count)
+    j = i + 1 + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    return i, j
+
+def wm_pairs(idx, legs, rmq, bull, max_span=None):
+    # 兩腳之間不得有比兩腳都低的底（W）或都高的頭（M），否則不是 W/M 的形狀
+    i, j = pivot_pairs(idx, max_span)
+    a, b = idx[i], idx[j]
+    if bull:
+        keep = rmq.min(a, b) >= np.minimum(legs[a], legs[b])
+    else:
+        keep = rmq.max(a, b) <= np.maximum(legs[a], legs[b])
+    return a[keep], b[keep]
+
+def wm_table(close, volume, idx1, idx2, neck, direction):
+    p1, p2 = close[idx1], close[idx2]
+    bull = direction == "bull"
+    if bull:
+        low = np.minimum(p1, p2)
+        hit = (np.abs(p1 - p2) / np.maximum(p1, p2) < 0.06) & ((neck - low) / low > 0.02)
+    else:
+        high = np.maximum(p1, p2)
+        hit = (np.abs(p1 - p2) / high < 0.06) & ((high - neck) / high > 0.02)
+    a, b = idx1[hit], idx2[hit]
+    pa, pb, nk = p1[hit], p2[hit], neck[hit]
+    n = len(a)
+    # 第二個底比第一個低（頭比第一個高）為發散，反之為收斂
+    worse, better = (pb < pa, pb > pa) if bull else (pb > pa, pb < pa)
+    divergence = np.where(worse, 3, np.where(better, 2, 1))
+    if bull:
+        low = np.minimum(pa, pb)
+        entry, stop, target = nk * 1.005, low * 0.98, nk + (nk - low)
+    else:
+        high = np.maximum(pa, pb)
+        entry, stop, target = nk * 0.995, high * 1.02, nk - (high - nk)
+    points = np.full((n, 5), -1, dtype=np.int64)
+    points[:, 0], points[:, 1] = a, b
+    prices = np.full((n, 5), np.nan)
+    prices[:, 0], prices[:, 1] = pa, pb
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vol_ratio = volume[b] / volume[a]
+    return PatternTable(np.full(n, _WM), np.full(n, 1 if bull else -1), points, prices, entry, stop, target,
+                        neck=nk, divergence=divergence, vol_ratio=vol_ratio)
+
+def wm_from_pairs(close, volume, idx1, idx2, neck, direction):
+    return wm_table(close, volume, idx1, idx2, neck, direction).to_records()
+
+def detect_wm_patterns(df, order=5, max_span=None, rmq=None, engine="close", threshold=None,
+                       as_table=False, pivots=None):
+    # pivots：已算好的 pivot_scan(...)[order]，有就直接沿用，不再重算樞紐
+    volume = df["Volume"].values.astype(float)
+    idx, kind, _ = pivots if pivots is not None else pivot_scan(df, [order], engine, threshold)[order]
+    highs_idx, lows_idx = idx[kind == 1], idx[kind == -1]
+    if engine == "close":
+        close = df["Close"].values.astype(float)
+        bottoms = tops = close
+        rmq = rmq if rmq is not None else RangeExtrema(close)
+        rmq_high = rmq_low = rmq
+    else:
+        # ZigZag：底取 Low、頭取 High，頸線為兩底之間的最高 High / 兩頭之間的最低 Low
+        tops, bottoms = df["High"].values.astype(float), df["Low"].values.astype(float)
+        rmq_high, rmq_low = RangeExtrema(tops), RangeExtrema(bottoms)
+    a, b = wm_pairs(lows_idx, bottoms, rmq_low, True, max_span)
+    bull = wm_table(bottoms, volume, a, b, rmq_high.max(a, b), "bull")
+    a, b = wm_pairs(highs_idx, tops, rmq_high, False, max_span)
+    bear = wm_table(tops, volume, a, b, rmq_low.min(a, b), "bear")
+    table = PatternTable.concat([bull, bear])
+    return table if as_table else table.to_records()
+
+class PatternTracker:
+    # 逐根餵入K棒；極值在其後 order 根K棒收完才確認，確認時只檢查受影響的形態。
+    # keep_results=False 時只回傳事件、不累積形態清單，長時間串流的記憶體維持有界
+    def __init__(self, order=5, max_span=None, bands=BUTTERFLY_BANDS, keep_results=True):
+        self.order = order
+        self.max_span = max_span
+        self.bands = bands
+        self.keep_results = keep_results
+        self.n = 0
+        self.offset = 0
+        self.closes = []
+        self.volumes = []
+        self.pivots = []
+        self.lows = []
+        self.highs = []
+        self.butterflies = []
+        self.wm_patterns = []
+
+    def copy(self):
+        other = PatternTracker()
+        other.__dict__.update(self.__dict__)
+        for name in ("closes", "volumes", "pivots", "lows", "highs", "butterflies", "wm_patterns"):
+            setattr(other, name, list(getattr(self, name)))
+        return other
+
+    def update(self, close, volume):
+        self.closes.append(float(close))
+        self.volumes.append(float(volume))
+        self.n += 1
+        events = []
+        i = self.n - 1 - self.order
+        if i >= 1:
+            events = self._check(i, self.n - 1)
+        self._trim()
+        return events
+
+    def flush(self):
+        # 序列結束時，依 argrelextrema 的邊界規則確認最後 order 根內的極值
+        events = []
+        for i in range(max(1, self.n - self.order), self.n - 1):
+            events += self._check(i, self.n - 1)
+        return events
+
+    def _check(self, i, last):
+        lo, hi = max(0, i - self.order) - self.offset, min(last, i + self.order) - self.offset
+        c = self.closes[i - self.offset]
+        others = self.closes[lo:i - self.offset] + self.closes[i - self.offset + 1:hi + 1]
+        if c > max(others):
+            return self._add_pivot(i, 1, c)
+        if c < min(others):
+            return self._add_pivot(i, -1, c)
+        return []
+
+    def _add_pivot(self, i, kind, price):
+        events = []
+        self.pivots = (self.pivots + [(i, kind, price)])[-5:]
+        if len(self.pivots) == 5:
+            idx, kinds, prices = (np.array(col) for col in zip(*self.pivots))
+            for bf in butterfly_windows(idx, kinds.astype(np.int8), prices, bands=self.bands):
+                if self.keep_results:
+                    self.butterflies.append(bf)
+                events.append({"kind": "butterfly", "bar": self.n - 1, "pattern": bf})
+
+        same = self.highs if kind == 1 else self.lows
+        earlier = [p for k, p in enumerate(same)
+                   if k == len(same) - 1 or (self.max_span and i - p <= self.max_span)]
+        close = np.asarray(self.closes)
+        between = [close[p - self.offset:i - self.offset + 1] for p in earlier]
+        # 與 wm_pairs 相同：兩腳之間有更低的底 / 更高的頭就不配對
+        keep = [b.min() >= min(b[0], b[-1]) if kind == -1 else b.max() <= max(b[0], b[-1]) for b in between]
+        earlier = [p for p, k in zip(earlier, keep) if k]
+        between = [b for b, k in zip(between, keep) if k]
+        if earlier:
+            neck = np.array([b.max() if kind == -1 else b.min() for b in between])
+            idx1 = np.array(earlier) - self.offset
+            idx2 = np.full(len(earlier), i - self.offset)
+            found = wm_from_pairs(close, np.asarray(self.volumes), idx1, idx2, neck,
+                                  "bull" if kind == -1 else "bear")
+            for wm in found:
+                wm["points"] = [p + self.offset for p in wm["points"]]
+                if self.keep_results:
+                    self.wm_patterns.append(wm)
+                events.append({"kind": "wm", "bar": self.n - 1, "pattern": wm})
+        same.append(i)
+        return events
+
+    def _trim(self):
+        # 只保留確認視窗、最近一次同類極值與 max_span 範圍內需要的K棒
+        horizon = self.n - 1 - 2 * self.order - (self.max_span or 0)
+        keep = horizon
+        for same in (self.lows, self.highs):
+            while len(same) > 1 and same[0] < horizon:
+                same.pop(0)
+            if same:
+                keep = min(keep, same[0])
+        keep = max(keep, 0)
+        if keep - self.offset > max(1024, len(self.closes) // 2):
+            del self.closes[:keep - self.offset]
+            del self.volumes[:keep - self.offset]
+            self.offset = keep
+
+def replay_patterns(df, order=5, max_span=None):
+    tracker = PatternTracker(order=order, max_span=max_span)
+    for c, v in zip(df["Close"].values, df["Volume"].values):
+        tracker.update(c, v)
+    tracker.flush()
+    return tracker.butterflies, tracker.wm_patterns
+
+CONFLUENCE_TOLERANCE = 0.005
+CONFLUENCE_RECENT = 10
+
+def pattern_levels(levels, order=5, max_span=None, recent=CONFLUENCE_RECENT, engine="close", threshold=None):
+    # 各週期跑同一組偵測器，取出最近 recent 個蝴蝶 D 點與 W底/M頭頸線的價位
+    rows = []
+    for interval, df in levels.items():
+        if len(df) < 2 * order + 1:
+            continue
+        bf = detect_butterfly(df, order=order, engine=engine, threshold=threshold, as_table=True)[-recent:]
+        wm = detect_wm_patterns(df, order=order, max_span=max_span, engine=engine, threshold=threshold,
+                                as_table=True)
+        wm = wm[np.argsort(wm.last_point, kind="stable")[-recent:]]
+        bars = np.concatenate([bf.last_point, wm.last_point])
+        rows.append(pd.DataFrame({
+            "interval": interval, "kind": ["butterfly"] * len(bf) + ["wm"] * len(wm),
+            "direction": np.where(np.concatenate([bf.direction, wm.direction]) > 0, "bull", "bear"),
+            "price": np.concatenate([bf.last_price, wm.neck]), "time": df.index[bars]}))
+    columns = ["interval", "kind", "direction", "price", "time"]
+    rows = [r for r in rows if len(r)]
+    return pd.concat(rows, ignore_index=True)[columns] if rows else pd.DataFrame(columns=columns)
+
+def confluence_levels(levels, order=5, max_span=None, tolerance=CONFLUENCE_TOLERANCE,
+                      recent=CONFLUENCE_RECENT, engine="close", threshold=None):
+    # 由低到高，每群涵蓋群內最低價往上 tolerance 的範圍；只保留跨兩個以上週期的群
+    found = pattern_levels(levels, order=order, max_span=max_span, recent=recent,
+                           engine=engine, threshold=threshold)
+    columns = ["price", "low", "high", "intervals", "kinds", "count", "timeframes", "last_time"]
+    if found.empty:
+        return pd.DataFrame(columns=columns)
+    found = found.sort_values("price", kind="stable").reset_index(drop=True)
+    price = found["price"].values
+    cluster = np.empty(len(price), dtype=np.int64)
+    i = k = 0
+    while i < len(price):
+        j = np.searchsorted(price, price[i] * (1 + tolerance), side="right")
+        cluster[i:j] = k
+        i, k = j, k + 1
+    found["cluster"] = cluster
+    rank = {lv: n for n, lv in enumerate(PYRAMID_LEVELS)}
+    rows = []
+    for _, g in found.groupby("cluster", sort=False):
+        intervals = sorted(g["interval"].unique(), key=lambda lv: rank.get(lv, len(rank)))
+        if len(intervals) < 2:
+            continue
+        rows.append({"price": float(g["price"].mean()), "low": float(g["price"].min()),
+                     "high": float(g["price"].max()), "intervals": intervals,
+                     "kinds": sorted(g["kind"].unique()), "count": len(g),
+                     "timeframes": len(intervals), "last_time": g["time"].max()})
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(rows, columns=columns).sort_values(
+        ["timeframes", "count", "last_time"], ascending=False).reset_index(drop=True)
+
+INDICATOR_COLUMNS = ["EMA20", "EMA50", "RSI", "MACD", "Signal_Line", "Histogram"]
+RSI_PERIOD = 14
+
+def ema_step(x, span, state):
+    # pandas ewm(adjust=True) 的加權平均可拆成兩條一階遞迴：
+    # num_t = x_t + β·num_{t-1}、den_t = 1 + β·den_{t-1}，EMA = num / den
+    from scipy.signal import lfilter
+    beta = 1 - 2 / (span + 1)
+    num0, den0 = state
+    num = lfilter([1.0], [1.0, -beta], x, zi=[beta * num0])[0]
+    den = lfilter([1.0], [1.0, -beta], np.ones(len(x)), zi=[beta * den0])[0]
+    return num / den, (float(num[-1]), float(den[-1]))
+
+class IndicatorEngine:
+    # 保存 EMA 遞迴狀態與 RSI 視窗尾端，追加 N 根K棒只需 O(N)
+    def __init__(self):
+        self.n = 0
+        self.last_close = None
+        self.ema = {span: (0.0, 0.0) for span in (12, 20, 26, 50)}
+        self.signal = (0.0, 0.0)
+        self.gains = np.empty(0)
+        self.losses = np.empty(0)
+
+    def copy(self):
+        other = IndicatorEngine()
+        other.__dict__.update(self.__dict__)
+        other.ema = dict(self.ema)
+        return other
+
+    def update(self, close):
+        close = np.asarray(close, dtype=float)
+        n = len(close)
+        if n == 0:
+            return {c: np.empty(0) for c in INDICATOR_COLUMNS}
+        out = {}
+        ema = {}
+        for span in self.ema:
+            ema[span], self.ema[span] = ema_step(close, span, self.ema[span])
+        out["EMA20"], out["EMA50"] = ema[20], ema[50]
+        out["MACD"] = ema[12] - ema[26]
+        out["Signal_Line"], self.signal = ema_step(out["MACD"], 9, self.signal)
+        out["Histogram"] = out["MACD"] - out["Signal_Line"]
+
+        prev = np.concatenate([[close[0] if self.last_close is None else self.last_close], close[:-1]])
+        delta = close - prev
+        gains = np.concatenate([self.gains, np.where(delta > 0, delta, 0.0)])
+        losses = np.concatenate([self.losses, np.where(delta < 0, -delta, 0.0)])
+        rsi = np.full(n, np.nan)
+        if len(gains) >= RSI_PERIOD:
+            gain = np.lib.stride_tricks.sliding_window_view(gains, RSI_PERIOD).mean(axis=1)
+            loss = np.lib.stride_tricks.sliding_window_view(losses, RSI_PERIOD).mean(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = 100 - (100 / (1 + gain / loss))
+            k = min(n, len(values))
+            rsi[n - k:] = values[len(values) - k:]
+        out["RSI"] = rsi
+        self.gains = gains[-(RSI_PERIOD - 1):]
+        self.losses = losses[-(RSI_PERIOD - 1):]
+        self.last_close = float(close[-1])
+        self.n += n
+        return out
+
+def indicator_arrays(close):
+    return IndicatorEngine().update(close)
+
+def compute_indicators(df):
+    return df.assign(**indicator_arrays(df["Close"].values))
+
+VOLUME_Z_WINDOW = 20
+VOLUME_Z_THRESHOLD = 3.5
+_Z_CHUNK = 1 << 12
+
+def _window_median(win):
+    k = win.shape[1] // 2
+    if win.shape[1] % 2:
+        return np.partition(win, k, axis=1)[:, k]
+    p = np.partition(win, [k - 1, k], axis=1)
+    return (p[:, k - 1] + p[:, k]) / 2
+
+def robust_volume_z(volume, window=VOLUME_Z_WINDOW):
+    # 以前 window 根（不含當根，爆量不會墊高自己的基準）的中位數與 MAD 標準化；
+    # MAD 為 0（量長時間不變）時改用平均絕對偏差，仍為 0 則不判定。分段計算以限制暫存記憶體
+    v = np.asarray(volume, dtype=float)
+    z = np.full(len(v), np.nan)
+    if len(v) <= window:
+        return z
+    win = np.lib.stride_tricks.sliding_window_view(v[:-1], window)
+    for s in range(0, len(win), _Z_CHUNK):
+        w = win[s:s + _Z_CHUNK]
+        med = _window_median(w)
+        dev = np.abs(w - med[:, None])
+        scale = 1.4826 * _window_median(dev)
+        scale = np.where(scale > 0, scale, 1.2533 * dev.mean(axis=1))
+        cur = v[window + s:window + s + len(w)]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z[window + s:window + s + len(w)] = np.where(scale > 0, (cur - med) / scale, np.nan)
+    return z
+
+def _settled_prefix(prev, df, columns):
+    # 上次已收完的K棒仍在這次資料開頭時（開頭可被週期視窗切掉幾根），回傳（切掉的根數, 沿用的根數）
+    if prev is None or not len(prev["index"]):
+        return None
+    old = prev["index"]
+    dropped = int(old.searchsorted(df.index[0]))
+    m = len(old) - dropped
+    if m <= 0 or m > len(df) - 1 or old[dropped] != df.index[0] or df.index[m - 1] != old[-1]:
+        return None
+    if any(df[c].values[m - 1] != prev["last_bar"][c] for c in columns):
+        return None
+    return dropped, m
+
+def incremental_volume_z(cache, key, df, window=VOLUME_Z_WINDOW):
+    # 每根的 z 只看前 window 根，已收完的部分直接沿用，只算新K棒
+    volume = df["Volume"].values.astype(float)
+    settled = len(df) - 1
+    prev = cache.get(("volume_z",) + key)
+    reuse = _settled_prefix(prev, df, ["Volume"])
+    if reuse:
+        dropped, m = reuse
+        s = max(m - window, 0)
+        z = np.concatenate([prev["z"][dropped:], robust_volume_z(volume[s:], window)[m - s:]])
+        # 開頭被切掉時，前 window 根與完整重算一樣視為樣本不足
+        z[:window] = np.nan
+    else:
+        z = robust_volume_z(volume, window)
+    if settled > 0:
+        cache.put(("volume_z",) + key, {"index": df.index[:settled], "z": z[:settled],
+                                        "last_bar": {"Volume": volume[settled - 1]}})
+    return z
+
+def volume_analysis(df, vol_z=None):
+    vol = df["Volume"]
+    close = df["Close"]
+    vol_ma20 = vol.rolling(20).mean()
+    vol_ma5 = vol.rolling(5).mean()
+    latest_vol = float(vol.iloc[-1])
+    avg_vol = float(vol_ma20.iloc[-1]) if not pd.isna(vol_ma20.iloc[-1]) else 1
+    vol_ratio = latest_vol / avg_vol if avg_vol > 0 else 1
+    price_up = float(close.iloc[-1]) > float(close.iloc[-5])
+    vol_up = latest_vol > avg_vol
+    if price_up and vol_up:
+        signal, color = "量價齊揚 ✅ (健康上漲)", "#3fb950"
+    elif price_up and not vol_up:
+        signal, color = "價漲量縮 ⚠️ (動能不足)", "#d29922"
+    elif not price_up and vol_up:
+        signal, color = "價跌量增 🚨 (恐慌賣出)", "#f85149"
+    else:
+        signal, color = "量價齊跌 ⚠️ (縮量整理)", "#58a6ff"
+    vol_z = robust_volume_z(vol.values) if vol_z is None else np.asarray(vol_z, dtype=float)
+    anomalies = np.flatnonzero(vol_z > VOLUME_Z_THRESHOLD)
+    return {
+        "vol_ma5": vol_ma5, "vol_ma20": vol_ma20,
+        "vol_ratio": vol_ratio, "signal": signal,
+        "signal_color": color, "vol_z": vol_z,
+        "anomalies": anomalies, "anomaly_dates": df.index[anomalies]
+    }
+
+PROFILE_BINS = 60
+PROFILE_VALUE_AREA = 0.70
+PROFILE_NODE_RATIO = 0.5
+
+def profile_step(low, high, bins=PROFILE_BINS):
+    # 取 1/2/5×10^k 的整齊價格間距，格數不超過 bins；間距固定後新K棒只需往同一組格子累加
+    span = float(np.max(high) - np.min(low))
+    raw = span / bins if span > 0 else max(abs(float(np.max(high))), 1.0) * 1e-3
+    base = 10.0 ** np.floor(np.log10(raw))
+    return float(next(base * m for m in (1, 2, 5, 10) if base * m >= raw))
+
+def _profile_grid(low, high, bins=PROFILE_BINS):
+    step = profile_step(low, high, bins)
+    k0 = int(np.floor(np.min(low) / step))
+    return step, k0, int(np.floor(np.max(high) / step)) - k0 + 1
+
+def _ramp(edges, at, slope):
+    # Σ slope_i · max(edges - at_i, 0)
+    order = np.argsort(at, kind="stable")
+    at, slope = at[order], slope[order]
+    j = np.searchsorted(at, edges, side="right")
+    return edges * np.r_[0.0, np.cumsum(slope)][j] - np.r_[0.0, np.cumsum(slope * at)][j]
+
+def profile_histogram(low, high, volume, step, k0, nbins):
+    # 每根K棒的量平均攤在 [Low, High]，各格分到的量為累積分配在兩側格邊的差；
+    # 排序加前綴和一次算出所有格邊，O(n log n)。格 j 涵蓋 [(k0+j)·step, (k0+j+1)·step)
+    lo = np.asarray(low, dtype=float) / step - k0
+    hi = np.asarray(high, dtype=float) / step - k0
+    vol = np.nan_to_num(np.asarray(volume, dtype=float))
+    flat = hi - lo < 1e-6
+    hist = np.bincount(np.clip(np.floor(lo[flat]).astype(np.int64), 0, nbins - 1),
+                       weights=vol[flat], minlength=nbins).astype(float)
+    lo, hi, vol = lo[~flat], hi[~flat], vol[~flat]
+    if len(lo):
+        slope = vol / (hi - lo)
+        edges = np.arange(nbins + 1, dtype=float)
+        hist += np.diff(_ramp(edges, lo, slope) - _ramp(edges, hi, slope))
+    return hist
+
+def _regrid(hist, k0, new_k0, n):
+    # 把格號 k0 起的直方圖搬到格號 new_k0 起、共 n 格的格子上（超出的格捨去、不足補 0）
+    out = np.zeros(n)
+    lo, hi = max(k0, new_k0), min(k0 + len(hist), new_k0 + n)
+    if lo < hi:
+        out[lo - new_k0:hi - new_k0] = hist[lo - k0:hi - k0]
+    return out
+
+def profile_summary(hist, step, k0, bins=PROFILE_BINS, value_area=PROFILE_VALUE_AREA,
+                    node_ratio=PROFILE_NODE_RATIO):
+    # 合併成不超過 bins 格（合併邊界對齊格號的倍數），再找 POC、價值區與高量節點
+    f = max(-(-len(hist) // bins), 1)
+    start = (k0 // f) * f
+    h = np.pad(hist, (k0 - start, -(k0 - start + len(hist)) % f)).reshape(-1, f).sum(axis=1)
+    width = step * f
+    low_edge = (start + np.arange(len(h)) * f) * step
+    price = low_edge + width / 2
+    poc = int(np.argmax(h))
+    # 價值區：由 POC 往量較大的一側逐格擴張，直到涵蓋 value_area 的量
+    target = value_area * h.sum()
+    lo = hi = poc
+    acc = h[poc]
+    while acc < target and (lo > 0 or hi < len(h) - 1):
+        down = h[lo - 1] if lo > 0 else -1.0
+        up = h[hi + 1] if hi < len(h) - 1 else -1.0
+        if up >= down:
+            hi, acc = hi + 1, acc + up
+        else:
+            lo, acc = lo - 1, acc + down
+    # 高量節點：分布的局部高點且量至少為 POC 的 node_ratio
+    padded = np.r_[-1.0, h, -1.0]
+    node = (h >= padded[:-2]) & (h > padded[2:]) & (h >= node_ratio * h[poc])
+    return {"price": price, "volume": h, "width": width, "poc": float(price[poc]),
+            "va_low": float(low_edge[lo]), "va_high": float(low_edge[hi] + width),
+            "nodes": price[node]}
+
+def volume_profile(df, bins=PROFILE_BINS, value_area=PROFILE_VALUE_AREA):
+    low, high, volume = (df[c].values.astype(float) for c in ("Low", "High", "Volume"))
+    step, k0, n = _profile_grid(low, high, bins)
+    return profile_summary(profile_histogram(low, high, volume, step, k0, n), step, k0, bins, value_area)
+
+def incremental_profile(cache, key, df, bins=PROFILE_BINS, value_area=PROFILE_VALUE_AREA):
+    # 與 volume_profile 同一組格子（間距與格數都由目前視窗決定，O(n) 的 min/max）：
+    # 間距不變時沿用快取的直方圖，新收完的K棒累加上去、被週期視窗切掉的K棒減回來；
+    # 間距變了就整段重建。未收完的最後一根只加在這次的輸出上
+    low, high, volume = (df[c].values.astype(float) for c in ("Low", "High", "Volume"))
+    settled = len(df) - 1
+    if settled < 1:
+        return volume_profile(df, bins, value_area)
+    step, k0, n = _profile_grid(low, high, bins)
+    prev = cache.get(("profile",) + key)
+    reuse = _settled_prefix(prev, df, ["Low", "High", "Volume"])
+    reuse = reuse if reuse and prev["step"] == step else None
+    metrics.inc("analyzer_profile_builds_total", mode="delta" if reuse else "full")
+    if reuse:
+        dropped, m = reuse
+        hist = prev["hist"] - profile_histogram(prev["low"][:dropped], prev["high"][:dropped],
+                                                prev["volume"][:dropped], step, prev["k0"], len(prev["hist"]))
+        hist = _regrid(hist, prev["k0"], k0, n)
+        hist = np.maximum(hist + profile_histogram(low[m:settled], high[m:settled], volume[m:settled],
+                                                   step, k0, n), 0)
+    else:
+        hist = profile_histogram(low[:settled], high[:settled], volume[:settled], step, k0, n)
+    cache.put(("profile",) + key, {"index": df.index[:settled], "low": low[:settled],
+                                   "high": high[:settled], "volume": volume[:settled],
+                                   "last_bar": {"Low": low[settled - 1], "High": high[settled - 1],
+                                                "Volume": volume[settled - 1]},
+                                   "step": step, "k0": k0, "hist": hist})
+    out = hist + profile_histogram(low[settled:], high[settled:], volume[settled:], step, k0, n)
+    return profile_summary(out, step, k0, bins, value_area)
+
+def nearest_node(levels, nodes):
+    # 各價位最近的高量節點與相對距離（%，節點高於價位為正）
+    levels = np.asarray(levels, dtype=float)
+    nodes = np.sort(np.asarray(nodes, dtype=float))
+    if not len(nodes):
+        return np.full(len(levels), np.nan), np.full(len(levels), np.nan)
+    j = np.searchsorted(nodes, levels)
+    below, above = nodes[np.clip(j - 1, 0, len(nodes) - 1)], nodes[np.clip(j, 0, len(nodes) - 1)]
+    node = np.where(np.abs(levels - below) <= np.abs(above - levels), below, above)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return node, np.where(levels > 0, (node / levels - 1) * 100, np.nan)
+
+BACKTEST_MAX_WAIT = 20
+BACKTEST_MAX_HOLD = 100
+
+def backtest_patterns(df, patterns, order, max_wait=BACKTEST_MAX_WAIT, max_hold=BACKTEST_MAX_HOLD,
+                      signal=None):
+    # 形態最後一個樞紐在其後 order 根K棒收完才確認，因此從確認後的下一根開始模擬，無未來資訊。
+    # 樞紐較晚才確定的演算法（ZigZag）另以 signal 傳入各形態的確認K棒（見 pattern_signal_bars）。
+    # 進場價在確認時收盤價之下（多方）視為限價單，之上視為突破單；同一根同時觸及止損與目標時以止損計。
+    columns = ["kind", "direction", "signal_bar", "filled", "fill_bar", "outcome",
+               "exit_bar", "exit_price", "r_multiple", "bars_held"]
+    if not isinstance(patterns, PatternTable):
+        patterns = PatternTable.from_records(patterns)
+    if not len(patterns):
+        return pd.DataFrame(columns=columns)
+    high, low, close = (df[c].values.astype(float) for c in ("High", "Low", "Close"))
+    n = len(close)
+    sign = patterns.direction.astype(float)
+    entry, stop, target = patterns.entry, patterns.stop_loss, patterns.target1
+    signal = patterns.last_point + order if signal is None else np.asarray(signal, dtype=np.int64)
+    start = signal + 1
+    ref = close[np.minimum(signal, n - 1)]
+
+    wait = start[:, None] + np.arange(max_wait)
+    in_range = wait < n
+    wait = np.minimum(wait, n - 1)
+    limit = (entry - ref) * sign <= 0
+    touch_down = low[wait] <= entry[:, None]
+    touch_up = high[wait] >= entry[:, None]
+    fill_hit = in_range & np.where(((sign > 0) == limit)[:, None], touch_down, touch_up)
+    filled = fill_hit.any(axis=1)
+    fill_bar = np.where(filled, start + fill_hit.argmax(axis=1), -1)
+
+    hold = np.maximum(fill_bar, 0)[:, None] + np.arange(max_hold)
+    in_hold = (hold < n) & filled[:, None]
+    hold = np.minimum(hold, n - 1)
+    stop_hit = in_hold & np.where(sign[:, None] > 0, low[hold] <= stop[:, None], high[hold] >= stop[:, None])
+    target_hit = in_hold & np.where(sign[:, None] > 0, high[hold] >= target[:, None],
+                                    low[hold] <= target[:, None])
+    never = max_hold + 1
+    k_stop = np.where(stop_hit.any(axis=1), stop_hit.argmax(axis=1), never)
+    k_target = np.where(target_hit.any(axis=1), target_hit.argmax(axis=1), never)
+    k_last = np.maximum(in_hold.sum(axis=1) - 1, 0)
+
+    outcome = np.where(~filled, "unfilled",
+              np.where((k_stop <= k_target) & (k_stop < never), "stop",
+              np.where(k_target < never, "target",
+              np.where(k_last == max_hold - 1, "timeout", "open"))))
+    k_exit = np.where(outcome == "stop", k_stop, np.where(outcome == "target", k_target, k_last))
+    exit_bar = np.where(filled, fill_bar + k_exit, -1)
+    exit_price = np.where(outcome == "stop", stop, np.where(outcome == "target", target,
+                                                            close[np.maximum(exit_bar, 0)]))
+    risk = np.abs(entry - stop)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r_multiple = np.where(filled & (risk > 0), (exit_price - entry) * sign / risk, np.nan)
+    return pd.DataFrame({
+        "kind": patterns.kind_names(),
+        "direction": np.where(sign > 0, "bull", "bear"),
+        "signal_bar": signal, "filled": filled, "fill_bar": fill_bar, "outcome": outcome,
+        "exit_bar": exit_bar, "exit_price": np.where(filled, exit_price, np.nan),
+        "r_multiple": r_multiple, "bars_held": np.where(filled, exit_bar - fill_bar, -1),
+    })[columns]
+
+def backtest_summary(trades):
+    total = len(trades)
+    filled = trades[trades["filled"]] if total else trades
+    nf = len(filled)
+    return {
+        "patterns": total,
+        "fill_rate": nf / total if total else np.nan,
+        "stop_rate": float((filled["outcome"] == "stop").mean()) if nf else np.nan,
+        "target_rate": float((filled["outcome"] == "target").mean()) if nf else np.nan,
+        "avg_r": float(filled["r_multiple"].mean()) if nf else np.nan,
+        "total_r": float(filled["r_multiple"].sum()) if nf else 0.0,
+        "avg_bars": float(filled["bars_held"].mean()) if nf else np.nan,
+    }
+
+def backtest_grid(frames, orders=PIVOT_ORDERS, band_grid=(BUTTERFLY_BANDS,), max_span=None,
+                  max_wait=BACKTEST_MAX_WAIT, max_hold=BACKTEST_MAX_HOLD):
+    # frames: {symbol: OHLCV DataFrame}；每檔只找一次各階樞紐與建一次區間索引
+    trades = []
+    for symbol, df in frames.items():
+        if df is None or len(df) < 30:
+            continue
+        close = df["Close"].values.astype(float)
+        volume = df["Volume"].values.astype(float)
+        rmq = RangeExtrema(close)
+        for order, (highs, lows) in multi_order_pivots(close, orders).items():
+            arrays = pivot_arrays(close, highs, lows)
+            a, b = wm_pairs(lows, close, rmq, True, max_span)
+            bull = wm_table(close, volume, a, b, rmq.max(a, b), "bull")
+            a, b = wm_pairs(highs, close, rmq, False, max_span)
+            bear = wm_table(close, volume, a, b, rmq.min(a, b), "bear")
+            wm_trades = backtest_patterns(df, PatternTable.concat([bull, bear]), order,
+                                          max_wait=max_wait, max_hold=max_hold)
+            for b, bands in enumerate(band_grid):
+                t = backtest_patterns(df, butterfly_windows(*arrays, bands=bands, as_table=True), order,
+                                      max_wait=max_wait, max_hold=max_hold)
+                trades += [t.assign(symbol=symbol, order=order, bands=b),
+                           wm_trades.assign(symbol=symbol, order=order, bands=b)]
+    if not trades:
+        return pd.DataFrame()
+    trades = pd.concat(trades, ignore_index=True)
+    rows = [dict(order=order, bands=b, kind=kind, **backtest_summary(g))
+            for (order, b, kind), g in trades.groupby(["order", "bands", "kind"])]
+    return pd.DataFrame(rows)
+
+LOD_MAX_POINTS = 1500
+
+def bucket_view(y, starts, fill):
+    # 將序列依等寬區間排成 (區間數, 區間長度) 的矩陣，尾端不足以 fill 補齊
+    y = np.asarray(y, dtype=float)
+    size = starts[1] - starts[0] if len(starts) > 1 else len(y)
+    padded = np.full(len(starts) * size, fill)
+    padded[:len(y)] = np.where(np.isnan(y), fill, y)
+    return padded.reshape(len(starts), size)
+
+def minmax_indices(y, starts):
+    # 每個區間保留最小與最大值的原始索引，折線的振幅在降採樣後仍然完整
+    lo = bucket_view(y, starts, np.inf).argmin(axis=1) + starts
+    hi = bucket_view(y, starts, -np.inf).argmax(axis=1) + starts
+    idx = np.unique(np.concatenate([lo, hi]))
+    return idx[idx < len(y)]
+
+def peak_indices(y, starts):
+    idx = bucket_view(np.abs(np.asarray(y, dtype=float)), starts, -1.0).argmax(axis=1) + starts
+    return np.minimum(idx, len(y) - 1)
+
+def build_chart(df, butterflies, wm_patterns, vol_info, symbol, max_points=None, profile=None):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    fig = make_subplots(
+        rows=4, cols=1, shared_xaxes=True,
+        row_heights=[0.50, 0.18, 0.16, 0.16],
+        vertical_spacing=0.02,
+        subplot_titles=("", "成交量", "RSI", "MACD")
+    )
+    
+    dates = df.index
+    close = df["Close"].values
+    open_ = df["Open"].values
+    high = df["High"].values
+    low = df["Low"].values
+    volume = df["Volume"].values
+
+    # LOD：K棒遠多於可顯示的點數時，K線與成交量依區間聚合，指標線以 min-max 降採樣並改用 WebGL；
+    # 形態樞紐與標註仍使用原始日期與價格
+    lod = max_points is not None and len(df) > max_points
+    # 圖上只標最近兩個形態；欄式結果到這裡才轉成含顯示字串的紀錄
+    if isinstance(butterflies, PatternTable):
+        butterflies = butterflies[-2:].to_records()
+    if isinstance(wm_patterns, PatternTable):
+        wm_patterns = wm_patterns[-2:].to_records()
+    Line = go.Scattergl if lod else go.Scatter
+    bar_dates = dates
+    if lod:
+        starts = np.arange(0, len(df), -(-len(df) // max_points))
+        ends = np.r_[starts[1:], len(df)] - 1
+        bar_dates = dates[starts]
+        open_, close = open_[starts], close[ends]
+        high, low = np.maximum.reduceat(high, starts), np.minimum.reduceat(low, starts)
+        # 成交量取區間平均，才與逐K棒計算的量MA5/量MA20同一尺度
+        volume = np.add.reduceat(volume.astype(float), starts) / np.diff(np.r_[starts, len(df)])
+
+    def line(y):
+        y = np.asarray(y, dtype=float)
+        if not lod:
+            return dict(x=dates, y=y)
+        idx = minmax_indices(y, starts)
+        return dict(x=dates[idx], y=y[idx])
+
+    fig.add_trace(go.Candlestick(
+        x=bar_dates, open=open_, high=high, low=low, close=close,
+        name="K線",
+        increasing_line_color="#3fb950", decreasing_line_color="#f85149",
+        increasing_fillcolor="#3fb950", decreasing_fillcolor="#f85149",
+    ), row=1, col=1)
+
+    fig.add_trace(Line(**line(df["EMA20"]), name="EMA20",
+                       line=dict(color="#f0a500", width=1.2), opacity=0.8), row=1, col=1)
+    fig.add_trace(Line(**line(df["EMA50"]), name="EMA50",
+                       line=dict(color="#58a6ff", width=1.2), opacity=0.8), row=1, col=1)
+
+    for bf in butterflies[-2:]:
+        pts = bf["points"]
+        prices = bf["prices"]
+        color = "#3fb950" if bf["direction"] == "bull" else "#f85149"
+        bf_dates = [dates[p] for p in pts]
+        fig.add_trace(go.Scatter(
+            x=bf_dates, y=prices, mode="lines+markers+text",
+            name=bf["type"], line=dict(color=color, width=1.5, dash="dash"),
+            marker=dict(size=9, color=color),
+            text=bf["labels"], textposition="top center",
+            textfont=dict(size=10, color=color),
+        ), row=1, col=1)
+        for lvl, lbl, lc in [
+            (bf["entry"], "進場", color),
+            (bf["stop_loss"], "止損", "#f85149"),
+            (bf["target1"], "目標1", "#3fb950"),
+        ]:
+            fig.add_hline(y=lvl, line_dash="dot", line_color=lc, line_width=0.8,
+                          opacity=0.5, row=1, col=1,
+                          annotation_text=lbl + ": " + str(round(lvl, 2)),
+                          annotation_font_color=lc, annotation_font_size=9)
+
+    for wm in wm_patterns[-2:]:
+        pts = wm["points"]
+        prices = wm["prices"]
+        color = "#3fb950" if wm["direction"] == "bull" else "#f85149"
+        wm_dates = [dates[p] for p in pts]
+        marker_sym = "triangle-up" if wm["direction"] == "bull" else "triangle-down"
+        fig.add_trace(go.Scatter(
+            x=wm_dates, y=prices, mode="markers",
+            name=wm["type"],
+            marker=dict(size=14, color=color, symbol=marker_sym),
+        ), row=1, col=1)
+        fig.add_hline(y=wm["neck"], line_dash="dashdot", line_color=color,
+                      line_width=1.2, opacity=0.7, row=1, col=1,
+                      annotation_text="頸線: " + str(round(wm["neck"], 2)),
+                      annotation_font_color=color, annotation_font_size=9,
+                      annotation_position="right")
+        fig.add_hline(y=wm["target"], line_dash="dot", line_color="#d29922",
+                      line_width=0.8, opacity=0.5, row=1, col=1,
+                      annotation_text="目標: " + str(round(wm["target"], 2)),
+                      annotation_font_color="#d29922", annotation_font_size=9,
+                      annotation_position="right")
+
+    vol_colors = np.where(close >= open_, "#3fb950", "#f85149")
+    fig.add_trace(go.Bar(x=bar_dates, y=volume, name="成交量",
+                          marker_color=vol_colors, opacity=0.65), row=2, col=1)
+    fig.add_trace(Line(**line(vol_info["vol_ma5"]), name="量MA5",
+                       line=dict(color="#f0a500", width=1), opacity=0.85), row=2, col=1)
+    fig.add_trace(Line(**line(vol_info["vol_ma20"]), name="量MA20",
+                       line=dict(color="#58a6ff", width=1), opacity=0.85), row=2, col=1)
+
+    # 異常量全部畫在同一條軌跡；LOD 時標在所屬的聚合K棒上
+    anomalies = vol_info["anomalies"]
+    if len(anomalies):
+        z = vol_info["vol_z"][anomalies]
+        if lod:
+            bucket = np.searchsorted(starts, anomalies, side="right") - 1
+            bucket, first = np.unique(bucket, return_index=True)
+            z = np.maximum.reduceat(z, first)
+            ax, ay = bar_dates[bucket], volume[bucket]
+        else:
+            ax, ay = dates[anomalies], volume[anomalies]
+        fig.add_trace(Line(
+            x=ax, y=ay, mode="markers", name="異常量",
+            marker=dict(size=8, color="#d29922", symbol="star"),
+            text=np.char.add("異常量 z=", np.round(z, 1).astype(str)), hoverinfo="x+y+text",
+            showlegend=False
+        ), row=2, col=1)
+
+    if profile is not None and len(profile["volume"]):
+        # 成交量分布畫成價格面板左側的橫條（獨立的 x 軸疊在K線上），另標 POC 與價值區
+        fig.add_trace(go.Bar(
+            x=profile["volume"], y=profile["price"], orientation="h", name="成交量分布",
+            width=profile["width"] * 0.9, marker_color="#8b949e", opacity=0.25,
+            xaxis="x5", yaxis="y", hovertemplate="%{y:.4f}<br>量 %{x:,.0f}<extra></extra>",
+        ))
+        fig.update_layout(xaxis5=dict(overlaying="x", anchor="y", side="top", visible=False,
+                                      range=[0, float(profile["volume"].max()) * 4]))
+        fig.add_hrect(y0=profile["va_low"], y1=profile["va_high"], fillcolor="#8b949e",
+                      opacity=0.06, line_width=0, row=1, col=1)
+        fig.add_hline(y=profile["poc"], line_dash="solid", line_color="#a371f7",
+                      line_width=1, opacity=0.7, row=1, col=1,
+                      annotation_text="POC: " + str(round(profile["poc"], 2)),
+                      annotation_font_color="#a371f7", annotation_font_size=9,
+                      annotation_position="left")
+
+    fig.add_trace(Line(**line(df["RSI"]), name="RSI",
+                       line=dict(color="#58a6ff", width=1.5)), row=3, col=1)
+    fig.add_hline(y=70, line_dash="dash", line_color="#f85149", line_width=0.8, row=3, col=1)
+    fig.add_hline(y=30, line_dash="dash", line_color="#3fb950", line_width=0.8, row=3, col=1)
+    fig.add_hline(y=50, line_dash="dot", line_color="#8b949e", line_width=0.5, row=3, col=1)
+    fig.add_hrect(y0=70, y1=100, fillcolor="#f85149", opacity=0.05, row=3, col=1)
+    fig.add_hrect(y0=0, y1=30, fillcolor="#3fb950", opacity=0.05, row=3, col=1)
+
+    hist = df["Histogram"].values
+    hist_dates = dates
+    if lod:
+        idx = peak_indices(hist, starts)
+        hist, hist_dates = hist[idx], dates[idx]
+    hist_colors = np.where(np.nan_to_num(hist) >= 0, "#3fb950", "#f85149")
+    fig.add_trace(go.Bar(x=hist_dates, y=hist, name="MACD柱",
+                          marker_color=hist_colors, opacity=0.7), row=4, col=1)
+    fig.add_trace(Line(**line(df["MACD"]), name="MACD",
+                       line=dict(color="#f0a500", width=1.2)), row=4, col=1)
+    fig.add_trace(Line(**line(df["Signal_Line"]), name="Signal",
+                       line=dict(color="#58a6ff", width=1)), row=4, col=1)
+    fig.add_hline(y=0, line_color="#8b949e", line_width=0.5, row=4, col=1)
+
+    fig.update_layout(
+        title=dict(text="🦋  " + symbol + "  左側交易分析儀",
+                   font=dict(size=16, color="#e6edf3")),
+        paper_bgcolor="#0d1117", plot_bgcolor="#0d1117",
+        font=dict(color="#8b949e", size=11),
+        height=820,
+        legend=dict(bgcolor="rgba(13,17,23,0.8)", bordercolor="#30363d",
+                    borderwidth=1, font=dict(size=9)),
+        xaxis_rangeslider_visible=False,
+        margin=dict(l=60, r=60, t=60, b=40),
+    )
+    for i in range(1, 5):
+        fig.update_xaxes(gridcolor="#21262d", showgrid=True,
+                         zerolinecolor="#30363d", row=i, col=1)
+        fig.update_yaxes(gridcolor="#21262d", showgrid=True,
+                         zerolinecolor="#30363d", row=i, col=1)
+    fig.update_yaxes(range=[0, 100], row=3, col=1)
+    return fig
+
+PIPELINE_CACHE_BYTES = int(os.environ.get("PIPELINE_CACHE_MB", "256")) * 2**20
+
+def estimate_bytes(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=True).sum()) if isinstance(obj, pd.DataFrame) \
+            else int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, PatternTable):
+        return sum(getattr(obj, c).nbytes for c in PatternTable.COLUMNS)
+    if isinstance(obj, PatternTracker):
+        return sys.getsizeof(obj) + estimate_bytes(vars(obj))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_bytes(k) + estimate_bytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_bytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+class PipelineCache:
+    # 以位元組上限做 LRU 淘汰的行程內快取
+    def __init__(self, max_bytes=PIPELINE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                metrics.inc("analyzer_cache_events_total", cache="pipeline", event="miss")
+                return None
+            self._items.move_to_end(key)
+            metrics.inc("analyzer_cache_events_total", cache="pipeline", event="hit")
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = estimate_bytes(value)
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return value
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._items.popitem(last=False)[1][1]
+                metrics.inc("analyzer_cache_events_total", cache="pipeline", event="eviction")
+            metrics.set_gauge("analyzer_cache_bytes", self.bytes, cache="pipeline")
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        return value if value is not None else self.put(key, compute())
+
+def incremental_indicators(cache, key, df):
+    # 快取最後一根（可能尚未收完）之前的引擎狀態，新資料若以同樣的K棒開頭就只追加新K棒
+    close = df["Close"].values
+    settled = len(close) - 1
+    prev = cache.get(("engine",) + key)
+    if (prev is not None and 0 < prev["n"] <= settled and df.index[0] == prev["first"]
+            and df.index[prev["n"] - 1] == prev["last"] and close[prev["n"] - 1] == prev["last_close"]):
+        engine, m = prev["engine"].copy(), prev["n"]
+        head = {c: prev["values"][c] for c in INDICATOR_COLUMNS}
+    else:
+        engine, m = IndicatorEngine(), 0
+        head = {c: np.empty(0) for c in INDICATOR_COLUMNS}
+    body = engine.update(close[m:settled])
+    values = {c: np.concatenate([head[c], body[c]]) for c in INDICATOR_COLUMNS}
+    if settled > 0:
+        cache.put(("engine",) + key, {"engine": engine.copy(), "n": settled, "values": values,
+                                      "first": df.index[0], "last": df.index[settled - 1],
+                                      "last_close": close[settled - 1]})
+    last = engine.update(close[settled:])
+    return df.assign(**{c: np.concatenate([values[c], last[c]]) for c in INDICATOR_COLUMNS})
@@ -1,34 +1,21 @@
+import os
+import re
 import streamlit as st
-import yfinance as yf
-import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-from scipy.signal import argrelextrema
+import plotly.io as pio
 import warnings
-warnings.filterwarnings("ignore")
-
-st.set_page_config(
-    page_title="左側交易分析儀",
-    page_icon="🦋",
-    layout="wide",
-    initial_sidebar_state="expanded"
+import metrics
+from analysis import (
+    BACKTEST_MAX_HOLD, BACKTEST_MAX_WAIT, CONFLUENCE_TOLERANCE, HARMONIC_PATTERNS,
+    HARMONIC_TOLERANCE, LOD_MAX_POINTS, PIVOT_ENGINES, PIVOT_ORDERS, PROFILE_VALUE_AREA,
+    RATIO_NAMES, ZIGZAG_THRESHOLDS, BarStore, CSVSource, PatternTable, PatternTracker,
+    PipelineCache, SharedBarCache, YFinanceSource, backtest_patterns, backtest_summary,
+    base_interval, build_chart, butterfly_windows, confluence_levels, detect_wm_patterns,
+    harmonic_table, incremental_indicators, incremental_profile, incremental_pyramid,
+    incremental_volume_z, nearest_node, pattern_signal_bars, pivot_scan, volume_analysis,
 )
-
-st.markdown("""
-<style>
-    .stApp { background-color: #0d1117; color: #e6edf3; }
-    .block-container { padding-top: 1rem; }
-    .signal-bull { background: #1a3a2a; border-left: 4px solid #3fb950;
-                   padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
-    .signal-bear { background: #3a1a1a; border-left: 4px solid #f85149;
-                   padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
-    .signal-warn { background: #2e2a14; border-left: 4px solid #d29922;
-                   padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
-    .signal-info { background: #162032; border-left: 4px solid #58a6ff;
-                   padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
-</style>
-""", unsafe_allow_html=True)
+from scanner import SCAN_COLUMNS, scan_watchlist
+warnings.filterwarnings("ignore")
 
 QUICK_SYMBOLS = {
     "BTC": "BTC-USD",
@@ -45,411 +32,437 @@ QUICK_SYMBOLS = {
     "SPY": "SPY",
 }
 
-@st.cache_data(ttl=300)
+@st.cache_resource
+def get_bar_store():
+    source_dir = os.environ.get("BAR_SOURCE_DIR")
+    source = CSVSource(source_dir) if source_dir else YFinanceSource()
+    return BarStore(os.environ.get("BAR_STORE_DIR", ".bar_store"), source)
+
+@st.cache_resource
+def get_data_cache():
+    return SharedBarCache()
+
 def get_data(symbol, period, interval):
-    df = yf.download(symbol, period=period, interval=interval, progress=False)
-    if df.empty:
-        return pd.DataFrame()
-    if isinstance(df.columns, pd.MultiIndex):
-        df.columns = df.columns.get_level_values(0)
-    df.dropna(inplace=True)
-    return df
-
-def find_pivots(series, order=5):
-    highs = argrelextrema(series.values, np.greater, order=order)[0]
-    lows = argrelextrema(series.values, np.less, order=order)[0]
-    return highs, lows
-
-def detect_butterfly(df, order=5):
-    close = df["Close"]
-    highs_idx, lows_idx = find_pivots(close, order=order)
-    results = []
-    all_pivots = []
-    for i in lows_idx:
-        all_pivots.append((i, "low", float(close.iloc[i])))
-    for i in highs_idx:
-        all_pivots.append((i, "high", float(close.iloc[i])))
-    all_pivots.sort(key=lambda x: x[0])
-
-    for i in range(len(all_pivots) - 4):
-        p = all_pivots[i:i+5]
-        types = [x[1] for x in p]
-
-        if types == ["low", "high", "low", "high", "low"]:
-            X, A, B, C, D = [x[2] for x in p]
-            XA = A - X
-            AB = A - B
-            BC = C - B
-            CD = C - D
-            if XA > 0 and AB > 0 and BC > 0 and CD > 0:
-                r1, r2, r3 = AB/XA, BC/AB, CD/BC
-                if 0.70 <= r1 <= 0.90 and 0.30 <= r2 <= 0.95 and 1.40 <= r3 <= 2.80 and D < X:
-                    results.append({
-                        "type": "看漲蝴蝶 🦋↑", "direction": "bull",
-                        "points": [p[j][0] for j in range(5)],
-                        "prices": [p[j][2] for j in range(5)],
-                        "labels": ["X", "A", "B", "C", "D"],
-                        "entry": D, "stop_loss": D * 0.97,
-                        "target1": D + BC * 0.618, "target2": D + XA * 0.786,
-                        "ratios": {"AB/XA": r1, "BC/AB": r2, "CD/BC": r3}
-                    })
-
-        if types == ["high", "low", "high", "low", "high"]:
-            X, A, B, C, D = [x[2] for x in p]
-            XA = X - A
-            AB = B - A
-            BC = B - C
-            CD = D - C
-            if XA > 0 and AB > 0 and BC > 0 and CD > 0:
-                r1, r2, r3 = AB/XA, BC/AB, CD/BC
-                if 0.70 <= r1 <= 0.90 and 0.30 <= r2 <= 0.95 and 1.40 <= r3 <= 2.80 and D > X:
-                    results.append({
-                        "type": "看跌蝴蝶 🦋↓", "direction": "bear",
-                        "points": [p[j][0] for j in range(5)],
-                        "prices": [p[j][2] for j in range(5)],
-                        "labels": ["X", "A", "B", "C", "D"],
-                        "entry": D, "stop_loss": D * 1.03,
-                        "target1": D - BC * 0.618, "target2": D - XA * 0.786,
-                        "ratios": {"AB/XA": r1, "BC/AB": r2, "CD/BC": r3}
-                    })
-    return results
-
-def detect_wm_patterns(df, order=5):
-    close = df["Close"]
-    volume = df["Volume"]
-    highs_idx, lows_idx = find_pivots(close, order=order)
-    results = []
-
-    for i in range(len(lows_idx) - 1):
-        idx1, idx2 = lows_idx[i], lows_idx[i+1]
-        p1, p2 = float(close.iloc[idx1]), float(close.iloc[idx2])
-        between = close.iloc[idx1:idx2+1]
-        neck = float(between.max())
-        price_diff = abs(p1 - p2) / max(p1, p2)
-        neck_height = (neck - min(p1, p2)) / min(p1, p2)
-        if price_diff < 0.06 and neck_height > 0.02:
-            v1 = float(volume.iloc[idx1])
-            v2 = float(volume.iloc[idx2])
-            if p2 < p1:
-                sub, div = "發散W底 ⚠️", "diverge"
-            elif p2 > p1:
-                sub, div = "收斂W底 ✅", "converge"
-            else:
-                sub, div = "標準W底", "equal"
-            vol_txt = "✅量縮確認" if v2 < v1 else "⚠️量未縮"
-            results.append({
-                "type": "W底 " + sub, "direction": "bull", "divergence": div,
-                "points": [idx1, idx2], "prices": [p1, p2],
-                "neck": neck, "entry": neck * 1.005,
-                "stop_loss": min(p1, p2) * 0.98,
-                "target": neck + (neck - min(p1, p2)),
-                "vol_confirm": vol_txt,
-                "vol_ratio": round(v2/v1, 2) if v1 > 0 else 0
-            })
-
-    for i in range(len(highs_idx) - 1):
-        idx1, idx2 = highs_idx[i], highs_idx[i+1]
-        p1, p2 = float(close.iloc[idx1]), float(close.iloc[idx2])
-        between = close.iloc[idx1:idx2+1]
-        neck = float(between.min())
-        price_diff = abs(p1 - p2) / max(p1, p2)
-        neck_depth = (max(p1, p2) - neck) / max(p1, p2)
-        if price_diff < 0.06 and neck_depth > 0.02:
-            v1 = float(volume.iloc[idx1])
-            v2 = float(volume.iloc[idx2])
-            if p2 > p1:
-                sub, div = "發散M頭 ⚠️", "diverge"
-            elif p2 < p1:
-                sub, div = "收斂M頭 ✅", "converge"
-            else:
-                sub, div = "標準M頭", "equal"
-            vol_txt = "✅量縮確認" if v2 < v1 else "⚠️量放大"
-            results.append({
-                "type": "M頭 " + sub, "direction": "bear", "divergence": div,
-                "points": [idx1, idx2], "prices": [p1, p2],
-                "neck": neck, "entry": neck * 0.995,
-                "stop_loss": max(p1, p2) * 1.02,
-                "target": neck - (max(p1, p2) - neck),
-                "vol_confirm": vol_txt,
-                "vol_ratio": round(v2/v1, 2) if v1 > 0 else 0
-            })
-    return results
-
-def compute_indicators(df):
-    close = df["Close"]
-    df["EMA20"] = close.ewm(span=20).mean()
-    df["EMA50"] = close.ewm(span=50).mean()
-    delta = close.diff()
-    gain = delta.where(delta > 0, 0).rolling(14).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(14).mean()
-    df["RSI"] = 100 - (100 / (1 + gain / loss))
-    ema12 = close.ewm(span=12).mean()
-    ema26 = close.ewm(span=26).mean()
-    df["MACD"] = ema12 - ema26
-    df["Signal_Line"] = df["MACD"].ewm(span=9).mean()
-    df["Histogram"] = df["MACD"] - df["Signal_Line"]
-    return df
-
-def volume_analysis(df):
-    vol = df["Volume"]
-    close = df["Close"]
-    vol_ma20 = vol.rolling(20).mean()
-    vol_ma5 = vol.rolling(5).mean()
-    latest_vol = float(vol.iloc[-1])
-    avg_vol = float(vol_ma20.iloc[-1]) if not pd.isna(vol_ma20.iloc[-1]) else 1
-    vol_ratio = latest_vol / avg_vol if avg_vol > 0 else 1
-    price_up = float(close.iloc[-1]) > float(close.iloc[-5])
-    vol_up = latest_vol > avg_vol
-    if price_up and vol_up:
-        signal, color = "量價齊揚 ✅ (健康上漲)", "#3fb950"
-    elif price_up and not vol_up:
-        signal, color = "價漲量縮 ⚠️ (動能不足)", "#d29922"
-    elif not price_up and vol_up:
-        signal, color = "價跌量增 🚨 (恐慌賣出)", "#f85149"
+    # 所有 session 共用同一份唯讀資料；同時點同一代碼只會觸發一次下載
+    return get_data_cache().get((symbol, period, interval),
+                                lambda: get_bar_store().get(symbol, period, interval))
+
+def get_levels(symbol, period, interval):
+    # 只下載該週期可取得的最細K棒，較粗的K棒在本機聚合；最細K棒抓不到時退回直接下載
+    base = base_interval(period, interval)
+    df = get_data(symbol, period=period, interval=base)
+    if df.empty and base != interval:
+        return {interval: get_data(symbol, period=period, interval=interval)}
+    with metrics.stage("resample"):
+        return incremental_pyramid(get_pipeline_cache(), (symbol, period), df, base)
+
+def run_confluence(levels, symbol, period, pivot_order, wm_span, engine="close", threshold=None):
+    key = ("confluence", symbol, period, pivot_order, wm_span, engine, threshold) + tuple(
+        (lv, len(df), df.index[-1], float(df["Close"].iloc[-1])) for lv, df in levels.items() if len(df))
+    with metrics.stage("confluence"):
+        return get_pipeline_cache().get_or_compute(
+            key, lambda: confluence_levels(levels, order=pivot_order, max_span=wm_span,
+                                           engine=engine, threshold=threshold))
+
+@st.cache_resource
+def get_metrics_server():
+    port = os.environ.get("METRICS_PORT")
+    return metrics.start_metrics_server(int(port)) if port else None
+
+@st.cache_resource
+def get_pipeline_cache():
+    return PipelineCache()
+
+def run_pipeline(df, symbol, period, interval, pivot_order, wm_span, max_points=None,
+                 engine="close", threshold=None):
+    cache = get_pipeline_cache()
+    # 以最後一根K棒辨識資料版本；最後一根尚未收完時收盤價也會變動
+    data_key = (symbol, interval, period, df.index[-1], len(df), float(df["Close"].iloc[-1]))
+
+    def indicators_stage():
+        with metrics.stage("indicators"):
+            ind = incremental_indicators(cache, (symbol, interval, period), df)
+        with metrics.stage("volume"):
+            vol_info = volume_analysis(ind, vol_z=incremental_volume_z(cache, (symbol, interval, period), ind))
+        with metrics.stage("volume_profile"):
+            profile = incremental_profile(cache, (symbol, interval, period), ind)
+        with metrics.stage("butterfly"):
+            # 所有階數的樞紐只算一次，蝴蝶與諧波形態都從這份樞紐滑視窗
+            pivots = pivot_scan(ind, PIVOT_ORDERS, engine, threshold)
+            bf_by_order = {o: butterfly_windows(*piv, as_table=True) for o, piv in pivots.items()}
+        return {"df": ind, "vol_info": vol_info, "profile": profile, "bf_by_order": bf_by_order,
+                "pivots": pivots}
+
+    base = cache.get_or_compute(("indicators",) + data_key + (engine, threshold), indicators_stage)
+
+    def detection_stage():
+        with metrics.stage("wm_patterns"):
+            wm_patterns = detect_wm_patterns(base["df"], order=pivot_order, max_span=wm_span,
+                                             engine=engine, threshold=threshold, as_table=True,
+                                             pivots=base["pivots"][pivot_order])
+        with metrics.stage("chart_build"):
+            fig = build_chart(base["df"], base["bf_by_order"][pivot_order], wm_patterns,
+                              base["vol_info"], symbol, max_points=max_points, profile=base["profile"])
+        with metrics.stage("chart_serialize"):
+            fig_json = fig.to_json()
+        with metrics.stage("harmonics"):
+            harmonics = harmonic_table(*base["pivots"][pivot_order], tolerance=HARMONIC_TOLERANCE)
+        with metrics.stage("backtest"):
+            patterns = PatternTable.concat([base["bf_by_order"][pivot_order], wm_patterns])
+            # ZigZag 樞紐要等下一個反向樞紐成立才確定，訊號K棒改用確定的時間點
+            signal = signal_harmonic = None
+            if engine != "close":
+                idx, n = base["pivots"][pivot_order][0], len(base["df"])
+                signal = pattern_signal_bars(patterns, idx, pivot_order, n)
+                signal_harmonic = pattern_signal_bars(harmonics, idx, pivot_order, n)
+            bt = backtest_patterns(base["df"], patterns, pivot_order, signal=signal)
+            bt_harmonic = backtest_patterns(base["df"], harmonics, pivot_order, signal=signal_harmonic)
+        return {"wm_patterns": wm_patterns, "fig_json": fig_json, "backtest": bt,
+                "harmonics": harmonics, "backtest_harmonic": bt_harmonic}
+
+    detected = cache.get_or_compute(("detection",) + data_key +
+                                    (pivot_order, wm_span, max_points, engine, threshold),
+                                    detection_stage)
+    return dict(base, **detected)
+
+def track_new_patterns(df, symbol, interval, pivot_order, wm_span):
+    # 只把上次之後收完的K棒餵給串流追蹤器，回傳新完成的形態事件；
+    # 追蹤器存在跨 session 共用的快取裡，先複製再餵，兩個 session 同時更新也不會重複餵同一段K棒
+    cache = get_pipeline_cache()
+    key = ("tracker", symbol, interval, pivot_order, wm_span)
+    state = cache.get(key)
+    settled = df.iloc[:-1]
+    if state is not None and state["last"] in settled.index:
+        tracker, start, emit = state["tracker"].copy(), settled.index.get_loc(state["last"]) + 1, True
     else:
-        signal, color = "量價齊跌 ⚠️ (縮量整理)", "#58a6ff"
-    anomaly = vol[vol > vol_ma20 * 2].index.tolist()
-    return {
-        "vol_ma5": vol_ma5, "vol_ma20": vol_ma20,
-        "vol_ratio": vol_ratio, "signal": signal,
-        "signal_color": color, "anomaly_dates": anomaly[-5:]
-    }
-
-def build_chart(df, butterflies, wm_patterns, vol_info, symbol):
-    fig = make_subplots(
-        rows=4, cols=1, shared_xaxes=True,
-        row_heights=[0.50, 0.18, 0.16, 0.16],
-        vertical_spacing=0.02,
-        subplot_titles=("", "成交量", "RSI", "MACD")
+        tracker = PatternTracker(order=pivot_order, max_span=wm_span, keep_results=False)
+        start, emit = 0, False
+    events = []
+    # 追蹤器的K棒編號從第一次餵入算起，週期視窗往後滑動後就對不上目前的 df；
+    # 事件產生當下依「剛餵入那根」回推，把完成點換成時間戳記下來
+    for k, (c, v) in enumerate(zip(settled["Close"].values[start:], settled["Volume"].values[start:]),
+                               start):
+        for ev in tracker.update(c, v):
+            pos = k - (tracker.n - 1 - ev["pattern"]["points"][-1])
+            if pos >= 0:
+                events.append(dict(ev, time=settled.index[pos]))
+    if len(settled):
+        cache.put(key, {"tracker": tracker, "last": settled.index[-1]})
+    return events if emit else []
+
+def run_scanner(symbols, period, interval, pivot_order, wm_span, engine="close", threshold=None):
+    symbols = [s for s in dict.fromkeys(x.strip() for x in symbols) if s]
+    if not symbols:
+        st.warning("請輸入至少一個代碼")
+        return
+    store = get_bar_store()
+    progress = st.progress(0.0, text="📡 掃描中...")
+    table = st.empty()
+    rows = []
+    for row in scan_watchlist(symbols, lambda batch: store.get_many(batch, period, interval),
+                              order=pivot_order, max_span=wm_span, engine=engine, threshold=threshold):
+        rows.append(row)
+        progress.progress(len(rows) / len(symbols),
+                          text="📡 已完成 " + str(len(rows)) + " / " + str(len(symbols)))
+        table.dataframe(pd.DataFrame(rows, columns=SCAN_COLUMNS), use_container_width=True)
+    # 失敗的列只有代碼與錯誤，固定欄位讓全部失敗時也能排序
+    result = pd.DataFrame(rows, columns=SCAN_COLUMNS)
+    result = result.sort_values(["距今K棒", "代碼"], na_position="last").reset_index(drop=True)
+    progress.empty()
+    failed = int(result["錯誤"].notna().sum())
+    st.caption("共 " + str(len(result)) + " 檔，失敗 " + str(failed) + " 檔（點擊欄位標題可排序）")
+    table.dataframe(result, use_container_width=True, hide_index=True)
+
+def setup_page():
+    st.set_page_config(
+        page_title="左側交易分析儀",
+        page_icon="🦋",
+        layout="wide",
+        initial_sidebar_state="expanded"
     )
-    
-    dates = df.index
-    close = df["Close"].values
-    open_ = df["Open"].values
-    high = df["High"].values
-    low = df["Low"].values
-    volume = df["Volume"].values
-
-    fig.add_trace(go.Candlestick(
-        x=dates, open=open_, high=high, low=low, close=close,
-        name="K線",
-        increasing_line_color="#3fb950", decreasing_line_color="#f85149",
-        increasing_fillcolor="#3fb950", decreasing_fillcolor="#f85149",
-    ), row=1, col=1)
-
-    fig.add_trace(go.Scatter(x=dates, y=df["EMA20"], name="EMA20",
-                              line=dict(color="#f0a500", width=1.2), opacity=0.8), row=1, col=1)
-    fig.add_trace(go.Scatter(x=dates, y=df["EMA50"], name="EMA50",
-                              line=dict(color="#58a6ff", width=1.2), opacity=0.8), row=1, col=1)
-
-    for bf in butterflies[-2:]:
-        pts = bf["points"]
-        prices = bf["prices"]
-        color = "#3fb950" if bf["direction"] == "bull" else "#f85149"
-        bf_dates = [dates[p] for p in pts]
-        fig.add_trace(go.Scatter(
-            x=bf_dates, y=prices, mode="lines+markers+text",
-            name=bf["type"], line=dict(color=color, width=1.5, dash="dash"),
-            marker=dict(size=9, color=color),
-            text=bf["labels"], textposition="top center",
-            textfont=dict(size=10, color=color),
-        ), row=1, col=1)
-        for lvl, lbl, lc in [
-            (bf["entry"], "進場", color),
-            (bf["stop_loss"], "止損", "#f85149"),
-            (bf["target1"], "目標1", "#3fb950"),
-        ]:
-            fig.add_hline(y=lvl, line_dash="dot", line_color=lc, line_width=0.8,
-                          opacity=0.5, row=1, col=1,
-                          annotation_text=lbl + ": " + str(round(lvl, 2)),
-                          annotation_font_color=lc, annotation_font_size=9)
-
-    for wm in wm_patterns[-2:]:
-        pts = wm["points"]
-        prices = wm["prices"]
-        color = "#3fb950" if wm["direction"] == "bull" else "#f85149"
-        wm_dates = [dates[p] for p in pts]
-        marker_sym = "triangle-up" if wm["direction"] == "bull" else "triangle-down"
-        fig.add_trace(go.Scatter(
-            x=wm_dates, y=prices, mode="markers",
-            name=wm["type"],
-            marker=dict(size=14, color=color, symbol=marker_sym),
-        ), row=1, col=1)
-        fig.add_hline(y=wm["neck"], line_dash="dashdot", line_color=color,
-                      line_width=1.2, opacity=0.7, row=1, col=1,
-                      annotation_text="頸線: " + str(round(wm["neck"], 2)),
-                      annotation_font_color=color, annotation_font_size=9,
-                      annotation_position="right")
-        fig.add_hline(y=wm["target"], line_dash="dot", line_color="#d29922",
-                      line_width=0.8, opacity=0.5, row=1, col=1,
-                      annotation_text="目標: " + str(round(wm["target"], 2)),
-                      annotation_font_color="#d29922", annotation_font_size=9,
-                      annotation_position="right")
-
-    vol_colors = ["#3fb950" if close[i] >= open_[i] else "#f85149" for i in range(len(df))]
-    fig.add_trace(go.Bar(x=dates, y=volume, name="成交量",
-                          marker_color=vol_colors, opacity=0.65), row=2, col=1)
-    fig.add_trace(go.Scatter(x=dates, y=vol_info["vol_ma5"], name="量MA5",
-                              line=dict(color="#f0a500", width=1), opacity=0.85), row=2, col=1)
-    fig.add_trace(go.Scatter(x=dates, y=vol_info["vol_ma20"], name="量MA20",
-                              line=dict(color="#58a6ff", width=1), opacity=0.85), row=2, col=1)
-
-    for ad in vol_info["anomaly_dates"]:
-        if ad in df.index:
-            v = float(df.loc[ad, "Volume"])
-            fig.add_trace(go.Scatter(
-                x=[ad], y=[v], mode="markers+text",
-                marker=dict(size=8, color="#d29922", symbol="star"),
-                text=["異常量"], textposition="top center",
-                textfont=dict(size=8, color="#d29922"),
-                showlegend=False
-            ), row=2, col=1)
-
-    fig.add_trace(go.Scatter(x=dates, y=df["RSI"], name="RSI",
-                              line=dict(color="#58a6ff", width=1.5)), row=3, col=1)
-    fig.add_hline(y=70, line_dash="dash", line_color="#f85149", line_width=0.8, row=3, col=1)
-    fig.add_hline(y=30, line_dash="dash", line_color="#3fb950", line_width=0.8, row=3, col=1)
-    fig.add_hline(y=50, line_dash="dot", line_color="#8b949e", line_width=0.5, row=3, col=1)
-    fig.add_hrect(y0=70, y1=100, fillcolor="#f85149", opacity=0.05, row=3, col=1)
-    fig.add_hrect(y0=0, y1=30, fillcolor="#3fb950", opacity=0.05, row=3, col=1)
-
-    hist_colors = ["#3fb950" if v >= 0 else "#f85149" for v in df["Histogram"].fillna(0)]
-    fig.add_trace(go.Bar(x=dates, y=df["Histogram"], name="MACD柱",
-                          marker_color=hist_colors, opacity=0.7), row=4, col=1)
-    fig.add_trace(go.Scatter(x=dates, y=df["MACD"], name="MACD",
-                              line=dict(color="#f0a500", width=1.2)), row=4, col=1)
-    fig.add_trace(go.Scatter(x=dates, y=df["Signal_Line"], name="Signal",
-                              line=dict(color="#58a6ff", width=1)), row=4, col=1)
-    fig.add_hline(y=0, line_color="#8b949e", line_width=0.5, row=4, col=1)
-
-    fig.update_layout(
-        title=dict(text="🦋  " + symbol + "  左側交易分析儀",
-                   font=dict(size=16, color="#e6edf3")),
-        paper_bgcolor="#0d1117", plot_bgcolor="#0d1117",
-        font=dict(color="#8b949e", size=11),
-        height=820,
-        legend=dict(bgcolor="rgba(13,17,23,0.8)", bordercolor="#30363d",
-                    borderwidth=1, font=dict(size=9)),
-        xaxis_rangeslider_visible=False,
-        margin=dict(l=60, r=60, t=60, b=40),
-    )
-    for i in range(1, 5):
-        fig.update_xaxes(gridcolor="#21262d", showgrid=True,
-                         zerolinecolor="#30363d", row=i, col=1)
-        fig.update_yaxes(gridcolor="#21262d", showgrid=True,
-                         zerolinecolor="#30363d", row=i, col=1)
-    fig.update_yaxes(range=[0, 100], row=3, col=1)
-    return fig
+
+    st.markdown("""
+    <style>
+        .stApp { background-color: #0d1117; color: #e6edf3; }
+        .block-container { padding-top: 1rem; }
+        .signal-bull { background: #1a3a2a; border-left: 4px solid #3fb950;
+                       padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
+        .signal-bear { background: #3a1a1a; border-left: 4px solid #f85149;
+                       padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
+        .signal-warn { background: #2e2a14; border-left: 4px solid #d29922;
+                       padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
+        .signal-info { background: #162032; border-left: 4px solid #58a6ff;
+                       padding: 10px 14px; border-radius: 6px; margin: 6px 0; }
+    </style>
+    """, unsafe_allow_html=True)
+
+def show_analysis(symbol, period, interval, pivot_order, wm_span, lod, engine="close", threshold=None):
+    if not symbol:
+        st.warning("請輸入或選擇一個代碼")
+        return
+
+    with st.spinner("📡 正在下載 " + symbol + " 資料..."):
+        with metrics.stage("download"):
+            levels = get_levels(symbol, period, interval)
+    df = levels.get(interval, pd.DataFrame())
+    metrics.note(symbol=symbol, period=period, interval=interval, pivot_order=pivot_order,
+                 pivot_engine=engine, bars=len(df))
+
+    if df.empty:
+        st.error("❌ 無法取得 " + symbol + " 資料，請確認代碼是否正確")
+        return
+
+    result = run_pipeline(df, symbol, period, interval, pivot_order, wm_span,
+                          max_points=LOD_MAX_POINTS if lod else None, engine=engine, threshold=threshold)
+    df = result["df"]
+    # 串流追蹤器沿用收盤價極值的確認規則，只在該演算法下提示
+    if interval in ("5m", "15m") and engine == "close":
+        for ev in track_new_patterns(df, symbol, interval, pivot_order, wm_span)[-5:]:
+            st.toast("🔔 新形態完成：" + ev["pattern"]["type"] + " @ " + str(ev["time"]))
+    bf_by_order = result["bf_by_order"]
+    butterflies = bf_by_order[pivot_order]
+    wm_patterns = result["wm_patterns"]
+    vol_info = result["vol_info"]
+    metrics.note(butterflies=len(butterflies), wm_patterns=len(wm_patterns),
+                 figure_kb=round(len(result["fig_json"]) / 1024, 1))
+    metrics.set_gauge("analyzer_last_bars", len(df))
+    metrics.inc("analyzer_patterns_total", len(butterflies), kind="butterfly")
+    metrics.inc("analyzer_patterns_total", len(wm_patterns), kind="wm")
+
+    current = float(df["Close"].iloc[-1])
+    prev = float(df["Close"].iloc[-2])
+    chg = (current / prev - 1) * 100
+    rsi = float(df["RSI"].iloc[-1]) if not pd.isna(df["RSI"].iloc[-1]) else 0
+
+    c1, c2, c3, c4, c5 = st.columns(5)
+    c1.metric("現價", f"{current:,.4f}", f"{chg:+.2f}%")
+    c2.metric("RSI(14)", f"{rsi:.1f}",
+              "超買⚠️" if rsi > 70 else ("超賣⚠️" if rsi < 30 else "正常"))
+    c3.metric("量比", f"{vol_info['vol_ratio']:.2f}x")
+    bf_count = butterflies.counts().loc["butterfly"]
+    wm_count = wm_patterns.counts().loc["wm"]
+    c4.metric("蝴蝶形態", str(len(butterflies)) + " 個",
+              "看漲" + str(bf_count["bull"]) + " / 看跌" + str(bf_count["bear"]))
+    c5.metric("W底/M頭", str(len(wm_patterns)) + " 個",
+              "W底" + str(wm_count["bull"]) + " / M頭" + str(wm_count["bear"]))
+
+    sig_class = ("signal-bull" if "齊揚" in vol_info["signal"]
+                 else "signal-bear" if "恐慌" in vol_info["signal"]
+                 else "signal-warn")
+    st.markdown("<div class='" + sig_class + "'><b>📊 量能信號：</b>" +
+                vol_info["signal"] + "</div>", unsafe_allow_html=True)
+    profile = result["profile"]
+    st.markdown("<div class='signal-info'><b>📶 成交量分布：</b>POC <code>" + str(round(profile["poc"], 4)) +
+                "</code>　價值區 (" + str(round(PROFILE_VALUE_AREA * 100)) + "%) <code>" +
+                str(round(profile["va_low"], 4)) + " ~ " + str(round(profile["va_high"], 4)) +
+                "</code>　高量節點 " + str(len(profile["nodes"])) + " 個　異常量 " +
+                str(len(vol_info["anomalies"])) + " 根</div>", unsafe_allow_html=True)
+
+    def node_notes(table, label):
+        # 關鍵價位（蝴蝶 D 點 / 頸線）最近的高量節點
+        nodes, dist = nearest_node(table.key_level, profile["nodes"])
+        return ["" if pd.isna(n) else "<br><small>" + label + "近高量節點: <code>" + str(round(n, 4)) +
+                "</code>（" + f"{d:+.2f}%" + "）</small>" for n, d in zip(nodes, dist)]
+
+    confluence = run_confluence(levels, symbol, period, pivot_order, wm_span, engine, threshold) \
+        if len(levels) > 1 else None
+
+    with metrics.stage("chart_render"):
+        fig = pio.from_json(result["fig_json"])
+        if confluence is not None:
+            for _, zone in confluence.head(5).iterrows():
+                fig.add_hline(y=zone["price"], line_dash="dot", line_color="#d29922", line_width=1,
+                              annotation_text="共振 " + "/".join(zone["intervals"]),
+                              annotation_font_color="#d29922")
+        st.plotly_chart(fig, use_container_width=True)
+
+    col_a, col_b = st.columns(2)
+
+    with col_a:
+        st.markdown("### 🦋 蝴蝶形態詳情")
+        if len(butterflies):
+            recent = butterflies[-4:]
+            for bf, note in zip(recent.to_records(), node_notes(recent, "D點")):
+                cc = "signal-bull" if bf["direction"] == "bull" else "signal-bear"
+                st.markdown(
+                    "<div class='" + cc + "'><b>" + bf["type"] + "</b><br>"
+                    "進場: <code>" + str(round(bf["entry"], 4)) + "</code>　"
+                    "止損: <code>" + str(round(bf["stop_loss"], 4)) + "</code>　"
+                    "目標1: <code>" + str(round(bf["target1"], 4)) + "</code><br>"
+                    "<small>AB/XA: " + str(round(bf["ratios"]["AB/XA"], 3)) +
+                    " | BC/AB: " + str(round(bf["ratios"]["BC/AB"], 3)) +
+                    " | CD/BC: " + str(round(bf["ratios"]["CD/BC"], 3)) + "</small>" + note +
+                    "</div>", unsafe_allow_html=True)
+        else:
+            st.markdown("<div class='signal-info'>未偵測到蝴蝶形態，可調整靈敏度或延長週期</div>",
+                        unsafe_allow_html=True)
+
+    with col_b:
+        st.markdown("### 📐 W底 / M頭形態詳情")
+        if len(wm_patterns):
+            recent = wm_patterns[-4:]
+            for wm, note in zip(recent.to_records(), node_notes(recent, "頸線")):
+                cc = "signal-bull" if wm["direction"] == "bull" else "signal-bear"
+                st.markdown(
+                    "<div class='" + cc + "'><b>" + wm["type"] + "</b><br>"
+                    "頸線: <code>" + str(round(wm["neck"], 4)) + "</code>　"
+                    "進場: <code>" + str(round(wm["entry"], 4)) + "</code>　"
+                    "止損: <code>" + str(round(wm["stop_loss"], 4)) + "</code>　"
+                    "目標: <code>" + str(round(wm["target"], 4)) + "</code><br>"
+                    "<small>" + wm["vol_confirm"] + "　量比: " + str(wm["vol_ratio"]) + "</small>" + note +
+                    "</div>", unsafe_allow_html=True)
+        else:
+            st.markdown("<div class='signal-info'>未偵測到W底/M頭，可調整靈敏度或延長週期</div>",
+                        unsafe_allow_html=True)
+
+    with st.expander("🎚️ 各靈敏度蝴蝶形態數"):
+        st.dataframe(pd.DataFrame(
+            {o: bfs.counts().loc["butterfly"] for o, bfs in bf_by_order.items()}
+        ).T.rename(columns={"bull": "看漲", "bear": "看跌"}).rename_axis("靈敏度"), use_container_width=True)
+
+    if confluence is not None:
+        with st.expander("🧭 多週期共振（" + " / ".join(levels) + "）", expanded=not confluence.empty):
+            st.caption("各週期的蝴蝶 D 點與 W底/M頭頸線（各取最近幾個）價差在 " +
+                       str(CONFLUENCE_TOLERANCE * 100) + "% 以內且跨兩個以上週期者")
+            if confluence.empty:
+                st.markdown("<div class='signal-info'>目前沒有跨週期對齊的關鍵價位</div>",
+                            unsafe_allow_html=True)
+            else:
+                current_price = float(df["Close"].iloc[-1])
+                st.dataframe(pd.DataFrame({
+                    "價位": confluence["price"].round(4),
+                    "區間": confluence["low"].round(4).astype(str) + " ~ " + confluence["high"].round(4).astype(str),
+                    "週期": confluence["intervals"].map("/".join),
+                    "形態": confluence["kinds"].map(lambda ks: "、".join(
+                        {"butterfly": "蝴蝶D", "wm": "頸線"}[k] for k in ks)),
+                    "次數": confluence["count"],
+                    "距現價%": ((confluence["price"] / current_price - 1) * 100).round(2),
+                }), use_container_width=True, hide_index=True)
+
+    with st.expander("🎼 諧波形態（蝴蝶 / 加特利 / 蝙蝠 / 螃蟹 / 鯊魚 / AB=CD）"):
+        harmonics = result["harmonics"]
+        st.caption("比例允許偏離區間 " + str(round(HARMONIC_TOLERANCE * 100)) +
+                   "%；吻合度 1 = 各比例都在理想值，0.5 = 剛好落在區間邊界")
+        if len(harmonics):
+            h = harmonics[::-1][:20]
+            ratios = pd.DataFrame(h.ratios.round(3), columns=RATIO_NAMES)
+            st.dataframe(pd.DataFrame({
+                "形態": h.labels(), "完成時間": df.index[h.last_point],
+                "吻合度": h.score.round(3), "進場": h.entry.round(4), "止損": h.stop_loss.round(4),
+                "目標1": h.target1.round(4), "目標2": h.target2.round(4),
+            }).join(ratios), use_container_width=True, hide_index=True)
+            bt_h = result["backtest_harmonic"]
+            rows = []
+            for pat in HARMONIC_PATTERNS:
+                sm = backtest_summary(bt_h[bt_h["kind"] == pat["name"]])
+                if sm["patterns"]:
+                    rows.append({"形態": pat["label"], "樣本": sm["patterns"], "成交率": sm["fill_rate"],
+                                 "止損率": sm["stop_rate"], "達標率": sm["target_rate"],
+                                 "平均R": sm["avg_r"]})
+            st.dataframe(pd.DataFrame(rows).set_index("形態").style.format("{:.2f}", na_rep="-"),
+                         use_container_width=True)
+        else:
+            st.markdown("<div class='signal-info'>未偵測到諧波形態，可調整靈敏度或延長週期</div>",
+                        unsafe_allow_html=True)
+
+    with st.expander("📈 形態回測（依進場/止損/目標模擬）"):
+        bt = result["backtest"]
+        st.caption("形態確認（最後樞紐後 " + str(pivot_order) + " 根K棒）後才掛單；" +
+                   str(BACKTEST_MAX_WAIT) + " 根內未成交視為放棄，最多持有 " +
+                   str(BACKTEST_MAX_HOLD) + " 根")
+        rows = []
+        for kind, label in [("butterfly", "蝴蝶"), ("wm", "W底/M頭")]:
+            sm = backtest_summary(bt[bt["kind"] == kind])
+            rows.append({"形態": label, "樣本": sm["patterns"], "成交率": sm["fill_rate"],
+                         "止損率": sm["stop_rate"], "達標率": sm["target_rate"],
+                         "平均R": sm["avg_r"], "平均持有K棒": sm["avg_bars"]})
+        st.dataframe(pd.DataFrame(rows).set_index("形態").style.format("{:.2f}", na_rep="-"),
+                     use_container_width=True)
+
+    with st.expander("📄 查看原始資料（最近20筆）"):
+        show_cols = ["Open", "High", "Low", "Close", "Volume", "EMA20", "EMA50", "RSI", "MACD"]
+        show_df = df[show_cols].tail(20)
+        st.dataframe(show_df.style.format("{:.4f}"), use_container_width=True)
+
+def show_debug_panel(record):
+    with st.sidebar.expander("🛠 除錯面板", expanded=True):
+        if record is None:
+            st.caption("本次執行未記錄")
+            return
+        st.caption("總耗時 " + str(record["total_ms"]) + " ms　｜　K棒 " + str(record.get("bars", "-")) +
+                   "　｜　蝴蝶 " + str(record.get("butterflies", "-")) +
+                   "　｜　W/M " + str(record.get("wm_patterns", "-")))
+        if record["stages"]:
+            st.dataframe(pd.DataFrame(record["stages"]).set_index("stage"), use_container_width=True)
+        if record["counters"]:
+            st.dataframe(pd.Series(record["counters"], name="次數"), use_container_width=True)
 
 def main():
+    setup_page()
+    get_metrics_server()
     st.title("🦋 左側交易分析儀")
     st.caption("支援 BTC / 加密貨幣 / 台股 / 美股　｜　蝴蝶形態 x W底M頭 x 量能分析")
 
     with st.sidebar:
         st.markdown("### 設定")
-        st.markdown("**快捷選擇**")
-        cols = st.columns(2)
+        mode = st.radio("模式", ["單一標的", "清單掃描"], horizontal=True)
         quick_symbol = None
-        for idx, (label, sym) in enumerate(QUICK_SYMBOLS.items()):
-            if cols[idx % 2].button(label, key="btn_" + sym, use_container_width=True):
-                quick_symbol = sym
-
-        st.markdown("---")
-        custom = st.text_input("自訂代碼", placeholder="e.g. 2330.TW / TSLA / BTC-USD")
-        symbol = custom.strip() if custom.strip() else (quick_symbol or "BTC-USD")
+        symbol = None
+        if mode == "單一標的":
+            st.markdown("**快捷選擇**")
+            cols = st.columns(2)
+            for idx, (label, sym) in enumerate(QUICK_SYMBOLS.items()):
+                if cols[idx % 2].button(label, key="btn_" + sym, use_container_width=True):
+                    quick_symbol = sym
+
+            st.markdown("---")
+            custom = st.text_input("自訂代碼", placeholder="e.g. 2330.TW / TSLA / BTC-USD")
+            symbol = custom.strip() if custom.strip() else (quick_symbol or "BTC-USD")
+        else:
+            watchlist = st.text_area("掃描清單（每行或以逗號分隔）",
+                                     value="\n".join(QUICK_SYMBOLS.values()), height=200)
         period = st.selectbox("時間週期", ["1mo", "3mo", "6mo", "1y", "2y"], index=2)
         interval = st.selectbox("K棒間隔", ["1d", "1h", "15m", "5m"], index=0)
+        engine = st.selectbox("樞紐演算法", list(PIVOT_ENGINES), format_func=PIVOT_ENGINES.get,
+                              help="ZigZag 以 High/Low 找高低點並嚴格交替，平頂/平底也會被偵測")
+        threshold = None
+        if engine == "zigzag_pct":
+            threshold = st.slider("ZigZag 最小反轉幅度（%）", 1.0, 20.0,
+                                  ZIGZAG_THRESHOLDS[engine] * 100, step=0.5) / 100
+        elif engine == "zigzag_atr":
+            threshold = st.slider("ZigZag 最小反轉幅度（ATR 倍數）", 0.5, 6.0,
+                                  ZIGZAG_THRESHOLDS[engine], step=0.5)
         pivot_order = st.slider("極值靈敏度（越小越靈敏）", 3, 12, 5)
+        wm_span = st.slider("W底/M頭配對間距（K棒，0=僅相鄰樞紐）", 0, 300, 0, step=10)
+        lod = st.checkbox("長序列降採樣顯示（LOD）", value=True,
+                          help="K棒數超過 " + str(LOD_MAX_POINTS) + " 根時聚合K線並以 WebGL 繪製指標線")
+        debug = st.checkbox("🛠 顯示除錯面板（分段耗時與快取命中）", value=False)
         st.markdown("---")
         run = st.button("🔍 開始分析", use_container_width=True, type="primary")
         st.markdown("---")
         st.warning("⚠️ 本工具僅供技術分析參考，不構成任何投資建議。槓桿交易風險極高，務必設定止損。")
 
-    if run or quick_symbol:
-        if not symbol:
-            st.warning("請輸入或選擇一個代碼")
-            return
-
-        with st.spinner("📡 正在下載 " + symbol + " 資料..."):
-            df = get_data(symbol, period=period, interval=interval)
-
-        if df.empty:
-            st.error("❌ 無法取得 " + symbol + " 資料，請確認代碼是否正確")
-            return
-
-        df = compute_indicators(df)
-        butterflies = detect_butterfly(df, order=pivot_order)
-        wm_patterns = detect_wm_patterns(df, order=pivot_order)
-        vol_info = volume_analysis(df)
-
-        current = float(df["Close"].iloc[-1])
-        prev = float(df["Close"].iloc[-2])
-        chg = (current / prev - 1) * 100
-        rsi = float(df["RSI"].iloc[-1]) if not pd.isna(df["RSI"].iloc[-1]) else 0
-
-        c1, c2, c3, c4, c5 = st.columns(5)
-        c1.metric("現價", f"{current:,.4f}", f"{chg:+.2f}%")
-        c2.metric("RSI(14)", f"{rsi:.1f}",
-                  "超買⚠️" if rsi > 70 else ("超賣⚠️" if rsi < 30 else "正常"))
-        c3.metric("量比", f"{vol_info['vol_ratio']:.2f}x")
-        c4.metric("蝴蝶形態", str(len(butterflies)) + " 個",
-                  "看漲" + str(sum(1 for b in butterflies if b["direction"] == "bull")) +
-                  " / 看跌" + str(sum(1 for b in butterflies if b["direction"] == "bear")))
-        c5.metric("W底/M頭", str(len(wm_patterns)) + " 個",
-                  "W底" + str(sum(1 for w in wm_patterns if w["direction"] == "bull")) +
-                  " / M頭" + str(sum(1 for w in wm_patterns if w["direction"] == "bear")))
-
-        sig_class = ("signal-bull" if "齊揚" in vol_info["signal"]
-                     else "signal-bear" if "恐慌" in vol_info["signal"]
-                     else "signal-warn")
-        st.markdown("<div class='" + sig_class + "'><b>📊 量能信號：</b>" +
-                    vol_info["signal"] + "</div>", unsafe_allow_html=True)
-
-        fig = build_chart(df, butterflies, wm_patterns, vol_info, symbol)
-        st.plotly_chart(fig, use_container_width=True)
-
-        col_a, col_b = st.columns(2)
-
-        with col_a:
-            st.markdown("### 🦋 蝴蝶形態詳情")
-            if butterflies:
-                for bf in butterflies[-4:]:
-                    cc = "signal-bull" if bf["direction"] == "bull" else "signal-bear"
-                    st.markdown(
-                        "<div class='" + cc + "'><b>" + bf["type"] + "</b><br>"
-                        "進場: <code>" + str(round(bf["entry"], 4)) + "</code>　"
-                        "止損: <code>" + str(round(bf["stop_loss"], 4)) + "</code>　"
-                        "目標1: <code>" + str(round(bf["target1"], 4)) + "</code><br>"
-                        "<small>AB/XA: " + str(round(bf["ratios"]["AB/XA"], 3)) +
-                        " | BC/AB: " + str(round(bf["ratios"]["BC/AB"], 3)) +
-                        " | CD/BC: " + str(round(bf["ratios"]["CD/BC"], 3)) + "</small>"
-                        "</div>", unsafe_allow_html=True)
-            else:
-                st.markdown("<div class='signal-info'>未偵測到蝴蝶形態，可調整靈敏度或延長週期</div>",
-                            unsafe_allow_html=True)
-
-        with col_b:
-            st.markdown("### 📐 W底 / M頭形態詳情")
-            if wm_patterns:
-                for wm in wm_patterns[-4:]:
-                    cc = "signal-bull" if wm["direction"] == "bull" else "signal-bear"
-                    st.markdown(
-                        "<div class='" + cc + "'><b>" + wm["type"] + "</b><br>"
-                        "頸線: <code>" + str(round(wm["neck"], 4)) + "</code>　"
-                        "進場: <code>" + str(round(wm["entry"], 4)) + "</code>　"
-                        "止損: <code>" + str(round(wm["stop_loss"], 4)) + "</code>　"
-                        "目標: <code>" + str(round(wm["target"], 4)) + "</code><br>"
-                        "<small>" + wm["vol_confirm"] + "　量比: " + str(wm["vol_ratio"]) + "</small>"
-                        "</div>", unsafe_allow_html=True)
-            else:
-                st.markdown("<div class='signal-info'>未偵測到W底/M頭，可調整靈敏度或延長週期</div>",
-                            unsafe_allow_html=True)
-
-        with st.expander("📄 查看原始資料（最近20筆）"):
-            show_cols = ["Open", "High", "Low", "Close", "Volume", "EMA20", "EMA50", "RSI", "MACD"]
-            show_df = df[show_cols].tail(20)
-            st.dataframe(show_df.style.format("{:.4f}"), use_container_width=True)
+    if mode == "清單掃描":
+        if run:
+            run_scanner(re.split(r"[\s,]+", watchlist), period, interval, pivot_order, wm_span,
+                        engine, threshold)
+        else:
+            st.info("👈 在左側輸入代碼清單，再按「開始分析」進行批次掃描")
+        return
 
+    if run or quick_symbol:
+        st.session_state["symbol"] = symbol
+    # 分析後調整參數的重跑沿用同一代碼，由 pipeline 快取只重算受影響的階段
+    symbol = st.session_state.get("symbol")
+
+    if symbol is not None:
+        metrics.begin_run(force=debug)
+        try:
+            show_analysis(symbol, period, interval, pivot_order, wm_span, lod, engine, threshold)
+        finally:
+            record = metrics.end_run()
+        if debug:
+            show_debug_panel(record)
     else:
         st.info("👈 從左側選擇標的，或輸入自訂代碼，再按「開始分析」")
 
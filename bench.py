@@ -0,0 +1,154 @@
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from analysis import (
+    LOD_MAX_POINTS, build_chart, compute_indicators, detect_butterfly, detect_wm_patterns,
+    find_pivots, volume_analysis,
+)
+
+SIZES = [1_000, 100_000, 1_000_000]
+ORDERS = [3, 5, 12]
+FULL_CHART_MAX_BARS = 20_000
+BASELINE_PATH = "bench_baseline.json"
+
+# ---- 合成 OHLCV（固定亂數種子） ----
+
+def _bars_from_returns(returns, rng, start_price=100.0, freq="5min"):
+    n = len(returns)
+    close = start_price * np.exp(np.cumsum(returns))
+    open_ = np.r_[start_price, close[:-1]] * np.exp(rng.normal(0, 0.0005, n))
+    wick = np.abs(rng.normal(0, np.std(returns) * 0.6 + 1e-6, (2, n)))
+    high = np.maximum(open_, close) * (1 + wick[0])
+    low = np.minimum(open_, close) * (1 - wick[1])
+    # 成交量：對數常態基礎量 × 日內 U 型季節性 × 與報酬幅度正相關
+    base = rng.lognormal(12, 0.4, n)
+    phase = np.arange(n) % 78 / 78
+    seasonal = 1 + 0.8 * (phase - 0.5) ** 2 * 4
+    shock = 1 + 40 * np.abs(returns)
+    volume = np.round(base * seasonal * shock)
+    index = pd.date_range("2020-01-01", periods=n, freq=freq, tz="UTC")
+    return pd.DataFrame({"Open": open_, "High": high, "Low": low,
+                         "Close": np.round(close, 2), "Volume": volume}, index=index)
+
+def random_walk(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return _bars_from_returns(rng.normal(0, 0.002, n), rng)
+
+def trending(n, seed=0, drift=0.0004):
+    rng = np.random.default_rng(seed)
+    # 趨勢加上週期性回檔，讓樞紐與形態有一定密度
+    cycle = 0.0015 * np.sin(np.arange(n) / 40)
+    return _bars_from_returns(drift + cycle + rng.normal(0, 0.0015, n), rng)
+
+def regime_switching(n, seed=0, mean_regime=500):
+    rng = np.random.default_rng(seed)
+    # 兩狀態馬可夫：低波動盤整 / 高波動趨勢
+    switch = rng.random(n) < 1 / mean_regime
+    regime = np.cumsum(switch) % 2
+    vol = np.where(regime == 0, 0.001, 0.004)
+    drift = np.where(regime == 0, 0.0, rng.choice([-1, 1], n) * 0.0003)
+    drift = pd.Series(drift).where(switch | (np.arange(n) == 0)).ffill().values
+    return _bars_from_returns(drift + rng.normal(0, 1, n) * vol, rng)
+
+GENERATORS = {"random_walk": random_walk, "trending": trending, "regime_switching": regime_switching}
+
+# ---- 量測 ----
+
+def measure(fn, repeat):
+    gc.collect()
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+def stages(df, orders):
+    ind = compute_indicators(df)
+    vol_info = volume_analysis(ind)
+    yield "compute_indicators", {}, lambda: compute_indicators(df)
+    yield "volume_analysis", {}, lambda: volume_analysis(ind)
+    for order in orders:
+        yield "find_pivots", {"order": order}, lambda o=order: find_pivots(df["Close"], order=o)
+        yield "detect_butterfly", {"order": order}, lambda o=order: detect_butterfly(df, order=o)
+        yield "detect_wm_patterns", {"order": order}, lambda o=order: detect_wm_patterns(df, order=o)
+    bf = detect_butterfly(df, order=orders[0])
+    wm = detect_wm_patterns(df, order=orders[0])
+    if len(df) <= FULL_CHART_MAX_BARS:
+        yield "build_chart", {"lod": False}, lambda: build_chart(ind, bf, wm, vol_info, "BENCH").to_json()
+    yield "build_chart", {"lod": True}, lambda: build_chart(
+        ind, bf, wm, vol_info, "BENCH", max_points=LOD_MAX_POINTS).to_json()
+
+def run(sizes, orders, generators, repeat):
+    rows = []
+    for gen in generators:
+        for n in sizes:
+            df = GENERATORS[gen](n, seed=42)
+            for stage, params, fn in stages(df, orders):
+                seconds, peak, result = measure(fn, repeat if n < 1_000_000 else 1)
+                row = {"generator": gen, "bars": n, "stage": stage, **params,
+                       "seconds": seconds, "peak_mb": peak / 2**20}
+                if stage == "build_chart":
+                    row["json_mb"] = len(result) / 2**20
+                rows.append(row)
+                sys.stderr.write("%-16s %9d %-20s %-12s %9.4fs %8.1f MB\n" % (
+                    gen, n, stage, json.dumps(params), seconds, peak / 2**20))
+    return rows
+
+def row_key(row):
+    params = {k: row[k] for k in ("order", "lod") if k in row}
+    return "|".join([row["generator"], str(row["bars"]), row["stage"], json.dumps(params, sort_keys=True)])
+
+def compare(rows, baseline, tolerance, min_seconds=0.005):
+    # 只比較耗時超過 min_seconds 的項目，避免計時雜訊造成誤報
+    base = {row_key(r): r for r in baseline["rows"]}
+    regressions = []
+    for r in rows:
+        b = base.get(row_key(r))
+        if b and b["seconds"] >= min_seconds and r["seconds"] > b["seconds"] * tolerance:
+            regressions.append((row_key(r), b["seconds"], r["seconds"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="左側交易分析儀效能基準")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--orders", type=int, nargs="+", default=ORDERS)
+    parser.add_argument("--generators", nargs="+", default=list(GENERATORS), choices=list(GENERATORS))
+    parser.add_argument("--repeat", type=int, default=3, help="每項取最佳的重複次數（1M 根固定 1 次）")
+    parser.add_argument("--save-baseline", metavar="PATH", nargs="?", const=BASELINE_PATH,
+                        help="將結果存為基準（預設 " + BASELINE_PATH + "）")
+    parser.add_argument("--compare", metavar="PATH", nargs="?", const=BASELINE_PATH,
+                        help="與基準比較，變慢超過容忍度即以非零狀態結束")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="允許的耗時倍數（預設 1.25）")
+    args = parser.parse_args(argv)
+
+    rows = run(args.sizes, args.orders, args.generators, args.repeat)
+    result = {"python": platform.python_version(), "numpy": np.__version__,
+              "pandas": pd.__version__, "machine": platform.machine(), "rows": rows}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(rows, json.load(f), args.tolerance)
+        for key, before, after in regressions:
+            print("SLOWER  %s  %.4fs -> %.4fs (x%.2f)" % (key, before, after, after / before))
+        if regressions:
+            return 1
+        print("no regressions (tolerance x%.2f)" % args.tolerance)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
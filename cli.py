@@ -0,0 +1,139 @@
+import time
+
+_T0 = time.perf_counter()
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analysis import (
+    PatternTable, clean_bars, compute_indicators, detect_butterfly, detect_harmonics, detect_wm_patterns,
+    volume_analysis,
+)
+
+SOURCES = ("butterflies", "wm_patterns", "harmonics")
+
+_T_IMPORTS = time.perf_counter() - _T0
+
+def load_ohlcv(path):
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, index_col=0, parse_dates=True)
+    return clean_bars(df)
+
+def _plain(value):
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def analyze_file(path, order=5, max_span=None, as_table=False):
+    symbol = os.path.splitext(os.path.basename(path))[0]
+    try:
+        df = load_ohlcv(path)
+        if len(df) < 30:
+            return {"symbol": symbol, "file": path, "error": "資料不足"}
+        df = compute_indicators(df)
+        vol_info = volume_analysis(df)
+        rsi = float(df["RSI"].iloc[-1])
+        found = {
+            "butterflies": detect_butterfly(df, order=order, as_table=True),
+            "wm_patterns": detect_wm_patterns(df, order=order, max_span=max_span, as_table=True),
+            "harmonics": detect_harmonics(df, order=order, as_table=True),
+        }
+        if not as_table:
+            found = {k: _plain(t.to_records()) for k, t in found.items()}
+        return {
+            "symbol": symbol, "file": path, "bars": len(df),
+            "last_bar": str(df.index[-1]), "close": float(df["Close"].iloc[-1]),
+            "rsi": None if np.isnan(rsi) else rsi,
+            "vol_ratio": vol_info["vol_ratio"], "vol_signal": vol_info["signal"],
+            **found, "error": None,
+        }
+    except Exception as e:
+        return {"symbol": symbol, "file": path, "error": type(e).__name__ + ": " + str(e)}
+
+def _tables(results):
+    # (代碼, 偵測器, PatternTable)；source 標示來自哪個偵測器（諧波含放寬比例的蝴蝶）
+    for r in results:
+        for source in SOURCES:
+            t = r.get(source)
+            if t is not None and len(t):
+                yield r["symbol"], source, t
+
+def pattern_table(results):
+    # Parquet 輸出：一個形態一列的 Arrow 表，數值欄直接沿用偵測結果的陣列
+    import pyarrow as pa
+    parts = []
+    for symbol, source, t in _tables(results):
+        tab = t.to_arrow()
+        n = len(t)
+        tab = tab.add_column(0, "source", pa.DictionaryArray.from_arrays(
+            pa.array(np.full(n, SOURCES.index(source), dtype=np.int8)), pa.array(SOURCES)))
+        parts.append(tab.add_column(0, "symbol", pa.array(np.full(n, symbol, dtype=object), pa.string())))
+    if not parts:
+        tab = PatternTable.empty().to_arrow()
+        tab = tab.add_column(0, "source", pa.DictionaryArray.from_arrays(pa.array([], pa.int8()),
+                                                                          pa.array(SOURCES)))
+        return tab.add_column(0, "symbol", pa.array([], pa.string()))
+    return pa.concat_tables(parts)
+
+def pattern_frame(results):
+    # CSV 輸出：points/prices/ratios 攤平成各自的欄位
+    frames = [t.to_frame().assign(symbol=symbol, source=source) for symbol, source, t in _tables(results)]
+    if not frames:
+        frames = [PatternTable.empty().to_frame().assign(symbol="", source="")]
+    df = pd.concat(frames, ignore_index=True)
+    return df[["symbol", "source"] + [c for c in df.columns if c not in ("symbol", "source")]]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="左側交易分析儀：批次分析本機 OHLCV 檔案（CSV/Parquet）")
+    parser.add_argument("files", nargs="+", help="OHLCV 檔案，檔名即代碼")
+    parser.add_argument("--order", type=int, default=5, help="極值靈敏度（預設 5）")
+    parser.add_argument("--max-span", type=int, default=0, help="W底/M頭配對間距，0=僅相鄰樞紐")
+    parser.add_argument("--workers", type=int, default=None, help="平行行程數（預設 CPU 數）")
+    parser.add_argument("--out", default="-",
+                        help="輸出檔（.json、.parquet 或 .csv），預設輸出 JSON 到 stdout；Parquet/CSV 為一個形態一列")
+    parser.add_argument("--timing", action="store_true", help="在 stderr 顯示啟動與分析耗時")
+    args = parser.parse_args(argv)
+
+    as_table = args.out.endswith((".parquet", ".csv"))
+    t_start = time.perf_counter()
+    if len(args.files) == 1 or args.workers == 1:
+        results = [analyze_file(f, args.order, args.max_span, as_table) for f in args.files]
+    else:
+        n = len(args.files)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(analyze_file, args.files,
+                                    [args.order] * n, [args.max_span] * n, [as_table] * n))
+    t_analyze = time.perf_counter() - t_start
+
+    if args.out.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pq.write_table(pattern_table(results), args.out)
+    elif args.out.endswith(".csv"):
+        pattern_frame(results).to_csv(args.out, index=False)
+    elif args.out == "-":
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+    if args.timing:
+        sys.stderr.write("imports: %.1f ms, analyze: %.1f ms, files: %d, errors: %d\n" % (
+            _T_IMPORTS * 1000, t_analyze * 1000, len(results),
+            sum(1 for r in results if r["error"])))
+    return 1 if all(r["error"] for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 分段計時與快取計數。未啟用（預設）時 stage()/inc() 只做一次屬性檢查，幾乎沒有成本。
+# ANALYZER_METRICS=1 全程啟用；否則僅在 begin_run(force=True)（例如開啟除錯面板）的那次執行中記錄。
+
+ENABLED = (os.environ.get("ANALYZER_METRICS", "") not in ("", "0")
+           or bool(os.environ.get("METRICS_PORT")))
+TRACE_ALLOC = os.environ.get("ANALYZER_METRICS_ALLOC", "") not in ("", "0")
+
+logger = logging.getLogger("analyzer.metrics")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_local = threading.local()
+_lock = threading.Lock()
+_counters = {}
+_stage_sum = {}
+_stage_count = {}
+_gauges = {}
+_NULL = nullcontext()
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def _active():
+    return ENABLED or getattr(_local, "run", None) is not None
+
+def inc(name, value=1, **labels):
+    if not _active():
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    run = getattr(_local, "run", None)
+    if run is not None:
+        text = name + _label_text(labels)
+        run["counters"][text] = run["counters"].get(text, 0) + value
+
+def set_gauge(name, value, **labels):
+    if not _active():
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def note(**fields):
+    run = getattr(_local, "run", None)
+    if run is not None:
+        run["fields"].update(fields)
+
+def begin_run(force=False, alloc=TRACE_ALLOC):
+    if not (ENABLED or force):
+        _local.run = None
+        return None
+    started_trace = alloc and not tracemalloc.is_tracing()
+    if started_trace:
+        tracemalloc.start()
+    _local.run = {"t0": time.perf_counter(), "stages": [], "counters": {}, "fields": {},
+                  "alloc": alloc, "started_trace": started_trace}
+    return _local.run
+
+def end_run():
+    run = getattr(_local, "run", None)
+    _local.run = None
+    if run is None:
+        return None
+    if run["started_trace"]:
+        tracemalloc.stop()
+    record = {"total_ms": round((time.perf_counter() - run["t0"]) * 1000, 2),
+              "stages": run["stages"], "counters": run["counters"], **run["fields"]}
+    logger.info(json.dumps(record, ensure_ascii=False, default=str))
+    return record
+
+def stage(name):
+    if not _active():
+        return _NULL
+    return _timed_stage(name)
+
+@contextmanager
+def _timed_stage(name):
+    run = getattr(_local, "run", None)
+    tracing = run is not None and run["alloc"] and tracemalloc.is_tracing()
+    if tracing:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t
+        with _lock:
+            _stage_sum[name] = _stage_sum.get(name, 0.0) + seconds
+            _stage_count[name] = _stage_count.get(name, 0) + 1
+        if run is not None:
+            entry = {"stage": name, "ms": round(seconds * 1000, 2)}
+            if tracing:
+                entry["alloc_kb"] = round((tracemalloc.get_traced_memory()[1] - base) / 1024, 1)
+            run["stages"].append(entry)
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(k + '="' + str(v).replace('"', '\\"') + '"' for k, v in sorted(labels.items())) + "}"
+
+def prometheus_text():
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        stage_sum = dict(_stage_sum)
+        stage_count = dict(_stage_count)
+    lines = []
+    for name in sorted({k[0] for k in counters}):
+        lines.append("# TYPE " + name + " counter")
+        for (n, labels), v in sorted(counters.items()):
+            if n == name:
+                lines.append(name + _label_text(dict(labels)) + " " + repr(float(v)))
+    for name in sorted({k[0] for k in gauges}):
+        lines.append("# TYPE " + name + " gauge")
+        for (n, labels), v in sorted(gauges.items()):
+            if n == name:
+                lines.append(name + _label_text(dict(labels)) + " " + repr(float(v)))
+    if stage_sum:
+        lines.append("# TYPE analyzer_stage_seconds summary")
+        for name in sorted(stage_sum):
+            lines.append("analyzer_stage_seconds_sum" + _label_text({"stage": name}) + " " + repr(stage_sum[name]))
+            lines.append("analyzer_stage_seconds_count" + _label_text({"stage": name}) + " " + str(stage_count[name]))
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
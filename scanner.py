@@ -0,0 +1,73 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from analysis import PatternTable, compute_indicators, detect_butterfly, detect_wm_patterns, volume_analysis
+
+SCAN_BATCH = 50
+SCAN_COLUMNS = ["代碼", "現價", "RSI", "量比", "最新形態", "方向", "距今K棒", "進場", "距進場%", "錯誤"]
+
+def scan_symbol(symbol, df, order=5, max_span=None, engine="close", threshold=None):
+    try:
+        if df is None or len(df) < 30:
+            return {"代碼": symbol, "錯誤": "資料不足"}
+        df = compute_indicators(df)
+        patterns = PatternTable.concat([
+            detect_butterfly(df, order=order, engine=engine, threshold=threshold, as_table=True),
+            detect_wm_patterns(df, order=order, max_span=max_span, engine=engine, threshold=threshold,
+                               as_table=True)])
+        vol_info = volume_analysis(df)
+        close = float(df["Close"].iloc[-1])
+        rsi = float(df["RSI"].iloc[-1])
+        row = {
+            "代碼": symbol, "現價": close,
+            "RSI": round(rsi, 1) if not np.isnan(rsi) else None,
+            "量比": round(vol_info["vol_ratio"], 2),
+            "最新形態": None, "方向": None, "距今K棒": None,
+            "進場": None, "距進場%": None, "錯誤": None,
+        }
+        if len(patterns):
+            k = int(np.argmax(patterns.last_point))
+            entry = float(patterns.entry[k])
+            row.update({
+                "最新形態": patterns[k:k + 1].labels()[0],
+                "方向": "bull" if patterns.direction[k] > 0 else "bear",
+                "距今K棒": len(df) - 1 - int(patterns.last_point[k]),
+                "進場": round(entry, 4),
+                "距進場%": round((close / entry - 1) * 100, 2),
+            })
+        return row
+    except Exception as e:
+        return {"代碼": symbol, "錯誤": type(e).__name__ + ": " + str(e)}
+
+def scan_watchlist(symbols, load_batch, order=5, max_span=None, workers=None, engine="close", threshold=None):
+    # load_batch(symbols) -> {symbol: DataFrame}，逐批下載並邊下載邊把已完成的結果 yield 出去
+    symbols = list(dict.fromkeys(s.strip() for s in symbols if s.strip()))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        pending = {}
+
+        def drain(timeout):
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                sym = pending.pop(fut)
+                try:
+                    yield fut.result()
+                except Exception as e:
+                    yield {"代碼": sym, "錯誤": type(e).__name__ + ": " + str(e)}
+
+        for i in range(0, len(symbols), SCAN_BATCH):
+            batch = symbols[i:i + SCAN_BATCH]
+            try:
+                frames = load_batch(batch)
+            except Exception as e:
+                for sym in batch:
+                    yield {"代碼": sym, "錯誤": "下載失敗: " + str(e)}
+                continue
+            for sym in batch:
+                pending[pool.submit(scan_symbol, sym, frames.get(sym), order, max_span,
+                                    engine, threshold)] = sym
+            if pending:
+                yield from drain(0)
+        while pending:
+            yield from drain(None)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.signal import argrelextrema
+
+from analysis import butterfly_scan, detect_butterfly
+
+ORDERS = range(3, 13)
+
+def reference_butterfly(df, order=5):
+    # 向量化之前的逐視窗迴圈，作為比對基準
+    close = df["Close"]
+    highs_idx = argrelextrema(close.values, np.greater, order=order)[0]
+    lows_idx = argrelextrema(close.values, np.less, order=order)[0]
+    results = []
+    all_pivots = []
+    for i in lows_idx:
+        all_pivots.append((i, "low", float(close.iloc[i])))
+    for i in highs_idx:
+        all_pivots.append((i, "high", float(close.iloc[i])))
+    all_pivots.sort(key=lambda x: x[0])
+
+    for i in range(len(all_pivots) - 4):
+        p = all_pivots[i:i+5]
+        types = [x[1] for x in p]
+
+        if types == ["low", "high", "low", "high", "low"]:
+            X, A, B, C, D = [x[2] for x in p]
+            XA = A - X
+            AB = A - B
+            BC = C - B
+            CD = C - D
+            if XA > 0 and AB > 0 and BC > 0 and CD > 0:
+                r1, r2, r3 = AB/XA, BC/AB, CD/BC
+                if 0.70 <= r1 <= 0.90 and 0.30 <= r2 <= 0.95 and 1.40 <= r3 <= 2.80 and D < X:
+                    results.append({
+                        "type": "看漲蝴蝶 🦋↑", "direction": "bull",
+                        "points": [p[j][0] for j in range(5)],
+                        "prices": [p[j][2] for j in range(5)],
+                        "labels": ["X", "A", "B", "C", "D"],
+                        "entry": D, "stop_loss": D * 0.97,
+                        "target1": D + BC * 0.618, "target2": D + XA * 0.786,
+                        "ratios": {"AB/XA": r1, "BC/AB": r2, "CD/BC": r3}
+                    })
+
+        if types == ["high", "low", "high", "low", "high"]:
+            X, A, B, C, D = [x[2] for x in p]
+            XA = X - A
+            AB = B - A
+            BC = B - C
+            CD = D - C
+            if XA > 0 and AB > 0 and BC > 0 and CD > 0:
+                r1, r2, r3 = AB/XA, BC/AB, CD/BC
+                if 0.70 <= r1 <= 0.90 and 0.30 <= r2 <= 0.95 and 1.40 <= r3 <= 2.80 and D > X:
+                    results.append({
+                        "type": "看跌蝴蝶 🦋↓", "direction": "bear",
+                        "points": [p[j][0] for j in range(5)],
+                        "prices": [p[j][2] for j in range(5)],
+                        "labels": ["X", "A", "B", "C", "D"],
+                        "entry": D, "stop_loss": D * 1.03,
+                        "target1": D - BC * 0.618, "target2": D - XA * 0.786,
+                        "ratios": {"AB/XA": r1, "BC/AB": r2, "CD/BC": r3}
+                    })
+    return results
+
+def random_closes(n, seed, decimals=None):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    if decimals is not None:
+        # 四捨五入讓相鄰收盤價出現平手
+        close = np.round(close, decimals)
+    return pd.DataFrame({"Close": close},
+                        index=pd.date_range("2024-01-01", periods=n, freq="h"))
+
+def comparable(patterns):
+    # 新版另帶 pattern/score 欄位，比對時只看原有欄位
+    return [{k: v for k, v in p.items() if k not in ("pattern", "score")} for p in patterns]
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("decimals", [None, 2, 0])
+def test_butterfly_scan_matches_reference(seed, decimals):
+    df = random_closes(3000, seed, decimals)
+    scanned = butterfly_scan(df["Close"].values, orders=ORDERS)
+    found = 0
+    for order in ORDERS:
+        expected = reference_butterfly(df, order)
+        assert comparable(scanned[order]) == expected
+        assert comparable(detect_butterfly(df, order=order)) == expected
+        found += len(expected)
+    if decimals != 0:
+        assert found > 0
+
+def test_short_series():
+    for n in (0, 5, 12, 30):
+        df = random_closes(n, 0, 2)
+        for order in ORDERS:
+            assert comparable(detect_butterfly(df, order=order)) == reference_butterfly(df, order)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from analysis import LOD_MAX_POINTS, build_chart, compute_indicators, volume_analysis
+from bench import random_walk
+
+def trace(fig, name):
+    return next(t for t in fig.data if t.name == name)
+
+def test_lod_volume_matches_ma_scale():
+    df = compute_indicators(random_walk(15_000, seed=0))
+    vol_info = volume_analysis(df)
+    fig = build_chart(df, [], [], vol_info, "TEST", max_points=LOD_MAX_POINTS)
+    bars = np.asarray(trace(fig, "成交量").y, dtype=float)
+    assert len(bars) <= LOD_MAX_POINTS
+    # 聚合後的量柱與逐K棒的量均線必須同一尺度
+    for name in ("量MA5", "量MA20"):
+        ma = np.asarray(trace(fig, name).y, dtype=float)
+        ratio = np.median(bars) / np.nanmedian(ma)
+        assert 0.5 < ratio < 2
+    # 異常量星號標在所屬聚合K棒的量柱高度上
+    stars = next((t for t in fig.data if t.name == "異常量"), None)
+    if stars is not None:
+        assert np.isin(np.asarray(stars.y, dtype=float), bars).all()
+
+def test_full_chart_keeps_raw_volume():
+    df = compute_indicators(random_walk(500, seed=1))
+    fig = build_chart(df, [], [], volume_analysis(df), "TEST", max_points=LOD_MAX_POINTS)
+    np.testing.assert_array_equal(np.asarray(trace(fig, "成交量").y, dtype=float), df["Volume"].values)
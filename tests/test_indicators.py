@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis import (
+    INDICATOR_COLUMNS, IndicatorEngine, PipelineCache, compute_indicators, incremental_indicators,
+)
+
+def reference_indicators(df):
+    # 改成遞迴引擎之前的 pandas ewm/rolling 算法，作為比對基準
+    close = df["Close"]
+    out = pd.DataFrame(index=df.index)
+    out["EMA20"] = close.ewm(span=20).mean()
+    out["EMA50"] = close.ewm(span=50).mean()
+    delta = close.diff()
+    gain = delta.where(delta > 0, 0).rolling(14).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(14).mean()
+    out["RSI"] = 100 - (100 / (1 + gain / loss))
+    ema12 = close.ewm(span=12).mean()
+    ema26 = close.ewm(span=26).mean()
+    out["MACD"] = ema12 - ema26
+    out["Signal_Line"] = out["MACD"].ewm(span=9).mean()
+    out["Histogram"] = out["MACD"] - out["Signal_Line"]
+    return out
+
+def random_frame(n, seed):
+    rng = np.random.default_rng(seed)
+    close = np.round(100 * np.exp(np.cumsum(rng.normal(0, 0.01, n))), 2)
+    # 插入一段平盤與一段連漲，涵蓋 RSI 的 0/0 與漲跌比無限大
+    if n > 200:
+        close[100:130] = close[100]
+        close[150:170] = close[150] + np.arange(20) * 0.1
+    return pd.DataFrame({"Close": close}, index=pd.date_range("2024-01-01", periods=n, freq="h"))
+
+def assert_matches(values, expected):
+    for c in INDICATOR_COLUMNS:
+        got = np.asarray(values[c], dtype=float)
+        want = expected[c].values
+        # NaN 的位置必須一致，數值在浮點誤差內
+        np.testing.assert_array_equal(np.isnan(got), np.isnan(want), err_msg=c)
+        np.testing.assert_allclose(got, want, rtol=1e-9, atol=1e-9, err_msg=c)
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("n", [1, 13, 14, 15, 60, 3000])
+def test_compute_indicators_matches_reference(seed, n):
+    df = random_frame(n, seed)
+    assert_matches(compute_indicators(df), reference_indicators(df))
+
+@pytest.mark.parametrize("seed", range(4))
+def test_chunked_engine_matches_reference(seed):
+    df = random_frame(3000, seed)
+    rng = np.random.default_rng(seed)
+    cuts = np.unique(np.r_[0, rng.integers(0, len(df), 40), 1, 2, 14, len(df)])
+    engine = IndicatorEngine()
+    parts = [engine.update(df["Close"].values[a:b]) for a, b in zip(cuts[:-1], cuts[1:])]
+    parts.append(engine.update(df["Close"].values[len(df):]))
+    values = {c: np.concatenate([p[c] for p in parts]) for c in INDICATOR_COLUMNS}
+    assert engine.n == len(df)
+    assert_matches(values, reference_indicators(df))
+
+def test_incremental_indicators_matches_reference():
+    full = random_frame(3000, 7)
+    cache = PipelineCache()
+    key = ("TEST", "1h", "1y")
+    # 逐步加入新K棒，最後一根每次都先以未收完的收盤價出現
+    for end in range(200, 3000, 97):
+        df = full.iloc[:end].copy()
+        df.iloc[-1, 0] *= 1.001
+        assert_matches(incremental_indicators(cache, key, df), reference_indicators(df))
+        df = full.iloc[:end]
+        assert_matches(incremental_indicators(cache, key, df), reference_indicators(df))
+    # 開頭被切掉的視窗走完整重算
+    df = full.iloc[500:]
+    assert_matches(incremental_indicators(cache, key, df), reference_indicators(df))
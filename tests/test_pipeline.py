@@ -0,0 +1,31 @@
+import pytest
+
+import analysis
+import app
+from analysis import PatternTable, PipelineCache, detect_harmonics, detect_wm_patterns
+from bench import random_walk
+
+@pytest.mark.parametrize("engine", ["close", "zigzag_pct"])
+def test_pipeline_scans_pivots_once(monkeypatch, engine):
+    df = random_walk(3000, seed=2)
+    cache = PipelineCache()
+    monkeypatch.setattr(app, "get_pipeline_cache", lambda: cache)
+    calls = []
+    scan = analysis.pivot_scan
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return scan(*args, **kwargs)
+    monkeypatch.setattr(app, "pivot_scan", counted)
+    # 偵測階段不得自己再算樞紐
+    for name in ("pivot_scan", "find_pivots"):
+        monkeypatch.setattr(analysis, name, lambda *a, **k: pytest.fail("樞紐被重算"))
+    results = {order: app.run_pipeline(df, "TEST", "1mo", "5m", order, 30, engine=engine)
+               for order in (3, 5, 8)}
+    assert len(calls) == 1
+    monkeypatch.undo()
+    for order, result in results.items():
+        want = detect_harmonics(df, order=order, engine=engine, as_table=True)
+        assert result["harmonics"].to_records() == want.to_records()
+        want = detect_wm_patterns(df, order=order, max_span=30, engine=engine, as_table=True)
+        assert result["wm_patterns"].to_records() == want.to_records()
+        assert isinstance(result["harmonics"], PatternTable)
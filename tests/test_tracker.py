@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis import PatternTracker, detect_butterfly, detect_wm_patterns, estimate_bytes, replay_patterns
+from bench import random_walk
+
+def feed(tracker, df):
+    events = []
+    for c, v in zip(df["Close"].values, df["Volume"].values):
+        events += tracker.update(c, v)
+    return events
+
+def test_copy_leaves_shared_state_untouched():
+    df = random_walk(3000, seed=3)
+    shared = PatternTracker(order=5, keep_results=False)
+    feed(shared, df[:2000])
+    # 兩個 session 從同一份快取狀態各自複製後餵同一段K棒，結果相同且原狀態不變
+    a, b = shared.copy(), shared.copy()
+    events_a, events_b = feed(a, df[2000:]), feed(b, df[2000:])
+    assert shared.n == 2000 and a.n == b.n == 3000
+    assert len(events_a) > 0
+    assert [(e["kind"], e["pattern"]["points"]) for e in events_a] == \
+           [(e["kind"], e["pattern"]["points"]) for e in events_b]
+
+def test_streaming_tracker_stays_bounded():
+    df = random_walk(20_000, seed=4)
+    tracker = PatternTracker(order=5, keep_results=False)
+    assert len(feed(tracker, df)) > 0
+    assert tracker.butterflies == [] and tracker.wm_patterns == []
+    # 位元組估計要涵蓋K棒緩衝區，且不隨餵入根數無限成長
+    assert estimate_bytes(tracker) > 24 * len(tracker.closes)
+    assert len(tracker.closes) < 4096
+
+def random_bars(n, seed, decimals=None):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    if decimals is not None:
+        # 四捨五入讓相鄰收盤價出現平手
+        close = np.round(close, decimals)
+    return {"Close": close, "Volume": np.round(rng.lognormal(10, 0.5, n))}
+
+def key(p):
+    return (tuple(p["points"]), p["direction"])
+
+def test_replay_trims_buffer():
+    df = pd.DataFrame(random_bars(3000, 0, 2))
+    tracker = PatternTracker(order=5, max_span=40)
+    feed(tracker, df)
+    # 超過 1024 根才會觸發緩衝區裁切，下面的比對都跑在裁切過的緩衝區上
+    assert tracker.offset > 0
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("decimals", [None, 2])
+@pytest.mark.parametrize("max_span", [None, 40])
+def test_replay_matches_batch(seed, decimals, max_span):
+    df = pd.DataFrame(random_bars(3000, seed, decimals))
+    for order in (3, 5, 12):
+        bf, wm = replay_patterns(df, order=order, max_span=max_span)
+        assert sorted(bf, key=key) == sorted(detect_butterfly(df, order=order), key=key)
+        expected = detect_wm_patterns(df, order=order, max_span=max_span)
+        assert len(expected) > 0
+        assert sorted(wm, key=key) == sorted(expected, key=key)
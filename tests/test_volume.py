@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from analysis import (
+    PipelineCache, incremental_profile, incremental_volume_z, profile_step, robust_volume_z,
+    volume_profile,
+)
+from bench import random_walk
+
+def assert_same_profile(got, want):
+    assert got["width"] == want["width"]
+    np.testing.assert_array_equal(got["price"], want["price"])
+    np.testing.assert_allclose(got["volume"], want["volume"], rtol=1e-9, atol=1e-6 * want["volume"].sum())
+    for k in ("poc", "va_low", "va_high"):
+        assert got[k] == pytest.approx(want[k])
+    np.testing.assert_allclose(got["nodes"], want["nodes"])
+
+@pytest.mark.parametrize("seed", range(3))
+def test_sliding_window_matches_cold_build(seed):
+    full = random_walk(6000, seed=seed)
+    cache = PipelineCache()
+    key = ("TEST", "5m", "1mo")
+    rng = np.random.default_rng(seed)
+    start, end, reused = 0, 2000, 0
+    prev_step = None
+    while end < len(full):
+        df = full.iloc[start:end].copy()
+        # 最後一根先以未收完的量價出現，下一輪才收完
+        df.iloc[-1, df.columns.get_loc("Volume")] *= 0.5
+        assert_same_profile(incremental_profile(cache, key, df), volume_profile(df))
+        df = full.iloc[start:end]
+        assert_same_profile(incremental_profile(cache, key, df), volume_profile(df))
+        z = incremental_volume_z(cache, key, df)
+        np.testing.assert_allclose(z, robust_volume_z(df["Volume"].values), rtol=1e-12, equal_nan=True)
+        step = profile_step(df["Low"].values, df["High"].values)
+        reused += step == prev_step
+        prev_step = step
+        # 右端往後長幾根，左端不定期被週期視窗切掉一段
+        end += int(rng.integers(1, 60))
+        start += int(rng.integers(0, 80)) if rng.random() < 0.5 else 0
+    assert reused > 10
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis import detect_wm_patterns, find_pivots, replay_patterns
+
+def reference_wm(df, order=5, max_span=None, shape_rule=True):
+    # 逐對檢查的基準：相鄰同類樞紐一律配對，max_span 另外納入間距內的非相鄰樞紐；
+    # shape_rule 時兩腳之間有更低的底 / 更高的頭就不配對
+    close = df["Close"].values.astype(float)
+    highs_idx, lows_idx = find_pivots(df["Close"], order=order)
+    found = set()
+    for idx, bull in ((lows_idx, True), (highs_idx, False)):
+        for i in range(len(idx)):
+            for j in range(i + 1, len(idx)):
+                if j > i + 1 and not (max_span and idx[j] - idx[i] <= max_span):
+                    break
+                a, b = idx[i], idx[j]
+                p1, p2 = close[a], close[b]
+                between = close[a:b + 1]
+                if bull:
+                    if shape_rule and between.min() < min(p1, p2):
+                        continue
+                    neck = between.max()
+                    ok = abs(p1 - p2) / max(p1, p2) < 0.06 and (neck - min(p1, p2)) / min(p1, p2) > 0.02
+                else:
+                    if shape_rule and between.max() > max(p1, p2):
+                        continue
+                    neck = between.min()
+                    ok = abs(p1 - p2) / max(p1, p2) < 0.06 and (max(p1, p2) - neck) / max(p1, p2) > 0.02
+                if ok:
+                    found.add((int(a), int(b), "bull" if bull else "bear", float(neck)))
+    return found
+
+def keys(patterns):
+    return {(p["points"][0], p["points"][1], p["direction"], p["neck"]) for p in patterns}
+
+def random_frame(n, seed, decimals=None):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    if decimals is not None:
+        close = np.round(close, decimals)
+    return pd.DataFrame({"Close": close, "Volume": rng.lognormal(10, 0.5, n)},
+                        index=pd.date_range("2024-01-01", periods=n, freq="h"))
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("decimals", [None, 1])
+@pytest.mark.parametrize("max_span", [None, 40, 120])
+def test_wm_matches_reference(seed, decimals, max_span):
+    df = random_frame(3000, seed, decimals)
+    for order in (3, 5, 12):
+        got = keys(detect_wm_patterns(df, order=order, max_span=max_span))
+        assert got == reference_wm(df, order, max_span)
+        if max_span:
+            # max_span 只會多出非相鄰的配對，相鄰的結果不變
+            assert keys(detect_wm_patterns(df, order=order)) <= got
+
+@pytest.mark.parametrize("seed", range(6))
+def test_adjacent_pairs_without_ties_match_original(seed):
+    # 收盤價沒有平手時，相鄰樞紐之間不可能有更低的底，結果與原本的相鄰配對完全相同
+    df = random_frame(3000, seed)
+    for order in (3, 5, 12):
+        assert keys(detect_wm_patterns(df, order=order)) == reference_wm(df, order, shape_rule=False)
+
+def frame(close):
+    close = np.asarray(close, dtype=float)
+    return pd.DataFrame({"Close": close, "Volume": np.full(len(close), 1000.0)},
+                        index=pd.date_range("2024-01-01", periods=len(close), freq="h"))
+
+def ramp(*points, step=6):
+    # 依序在各價位之間線性插值，每段 step 根K棒
+    return np.concatenate([np.linspace(a, b, step, endpoint=False) for a, b in zip(points[:-1], points[1:])]
+                          + [[points[-1]]])
+
+def test_tied_deeper_low_between_adjacent_pivots_is_rejected():
+    # 100 與 99 兩個底之間有一段平手的 90：平手不算樞紐，兩底相鄰但中間更低，不是 W
+    close = ramp(110, 100, 110, 90)
+    close = np.r_[close, 90.0, ramp(90, 110, 99, 110)[1:]]
+    df = frame(close)
+    highs_idx, lows_idx = find_pivots(df["Close"], order=3)
+    assert [close[i] for i in lows_idx] == [100, 99]
+    for max_span in (None, 100):
+        found = detect_wm_patterns(df, order=3, max_span=max_span)
+        assert [p for p in found if p["direction"] == "bull"] == []
+        assert keys(replay_patterns(df, order=3, max_span=max_span)[1]) == keys(found)
+    # 舊的相鄰配對會把它當成 W 底
+    assert any(p[2] == "bull" for p in reference_wm(df, 3, shape_rule=False))
+
+def test_max_span_skips_pairs_with_a_deeper_pivot_between():
+    # 三個底 100 / 90 / 99：100 與 99 在 max_span 內，但中間的 90 更低，只有 W 底形狀的配對保留
+    df = frame(ramp(110, 100, 112, 90, 112, 99, 112, 98, 112))
+    lows = [100, 90, 99, 98]
+    highs_idx, lows_idx = find_pivots(df["Close"], order=3)
+    assert [df["Close"].values[i] for i in lows_idx] == lows
+    for max_span in (None, 100):
+        found = detect_wm_patterns(df, order=3, max_span=max_span)
+        pairs = {(df["Close"].values[p["points"][0]], df["Close"].values[p["points"][1]])
+                 for p in found if p["direction"] == "bull"}
+        # (100, 99)、(100, 98) 中間夾著 90 而被排除；(99, 98) 相鄰且形狀成立
+        assert pairs == {(99, 98)}
+        assert keys(replay_patterns(df, order=3, max_span=max_span)[1]) == keys(found)